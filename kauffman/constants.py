@@ -144,6 +144,8 @@ for k, v in MSA_TO_STATE_FIPS.items():
     for x in v:
         STATE_TO_MSA_FIPS.setdefault(x,[]).append(k)
 
+MSA_TO_N_STATES = {k: len(v) for k, v in MSA_TO_STATE_FIPS.items()}
+
 
 AGE_CODE_TO_LABEL = {
     0: 'Less than one year old',
@@ -268,6 +270,23 @@ QWI_MISSING_MSAS = {
     '54': ['34350']
 }
 
+QWI_BULK_URL = 'https://lehd.ces.census.gov/data/qwi/latest_release'
+QWI_BULK_CHUNKSIZE = 500000
+
+QWI_GEO_TO_BULK_GEOCAT = {
+    'state': 'gs',
+    'msa': 'gm',
+    'county': 'gc'
+}
+
+QWI_BULK_TO_API_COLS = {
+    'HirAS': 'HirAs',
+    'HirNS': 'HirNs'
+}
+
+
+ACS_CATALOG_URL = 'https://api.census.gov/data.json'
+ACS_VAR_LIMIT = 50
 
 ACS_CODE_TO_VAR = {
     'B24081_001E': 'total',
@@ -351,7 +370,141 @@ BDS_VALID_CROSSES = [
     {'EAGE', 'GEOCOMP', 'METRO', 'NAICS', 'STATE'}
 ]
 
+CACHE_DIR = os.environ.get(
+    'KAUFFMAN_CACHE_DIR', 
+    os.path.join(os.path.expanduser('~'), '.cache', 'kauffman')
+)
+
+VINTAGE_DIR = os.environ.get(
+    'KAUFFMAN_VINTAGE_DIR', os.path.join(CACHE_DIR, 'vintages')
+)
+
+# Bump these whenever the parser or schema of a stored source changes, so that
+# vintages (and cached tables) stored by an older version are rebuilt
+PEP_VINTAGE_VERSION = 3
+BED_VINTAGE_VERSION = 2
+BFS_TABLE_VERSION = 1
+
+BFS_URL = 'https://www.census.gov/econ_getzippedfile/?programCode=BFS'
+BFS_CHUNKSIZE = 500000
+
 BFS_SERIES = [
     'BA_BA', 'BA_CBA', 'BA_HBA', 'BA_WBA', 'BF_BF4Q', 'BF_BF8Q', 'BF_PBF4Q', 
     'BF_PBF8Q', 'BF_SBF4Q', 'BF_SBF8Q', 'BF_DUR4Q', 'BF_DUR8Q'
-]
\ No newline at end of file
+]
+
+# Layouts of the historical PEP text files. Each section is a range of lines
+# (an int index or a regex matching the first line of the next block) and the
+# whitespace-separated fields of a record: 'fips', 'state' (postal code), 
+# 'region' (possibly multi-word name), an int year for a population value, or
+# None for a skipped token. Overrides give the fields of irregular records by
+# fips. Populations are multiplied by scale. Files whose tables alternate page 
+# by page instead give blocks: the sections take turns, switching at every 
+# header line from the start line on, and the data ends at the stop record 
+# within the last section.
+PEP_TXT_URL = 'https://www2.census.gov/programs-surveys/popest/tables'
+
+
+def _pep_state_decade_layout(decade, url_code, lines, fields, scale):
+    return {
+        'url': f'{PEP_TXT_URL}/1980-1990/state/asrh/{url_code}.txt',
+        'sections': [
+            {'lines': line_range, 'fields': section_fields}
+            for line_range, section_fields in zip(lines, fields)
+        ],
+        'years': (decade, decade + 9),
+        'scale': scale
+    }
+
+
+PEP_STATE_DECADE_LAYOUTS = {
+    **{
+        decade: _pep_state_decade_layout(
+            decade, f'st{i}0{i}9ts', lines, 
+            [
+                ['state'] + list(range(decade, decade + 6)),
+                ['state'] + list(range(decade + 6, decade + 10))
+            ],
+            1000
+        )
+        for i, decade, lines in [
+            (0, 1900, [(23, 72), (82, -1)]),
+            (1, 1910, [(23, 72), (82, -1)]),
+            (2, 1920, [(23, 72), (82, -1)]),
+            (3, 1930, [(23, 72), (82, -1)]),
+            (4, 1940, [(21, 70), (79, -1)])
+        ]
+    },
+    **{
+        decade: _pep_state_decade_layout(
+            decade, f'st{i}0{i + 1}0ts', lines,
+            [
+                ['state', None] + list(range(decade, decade + 5)),
+                ['state'] + list(range(decade + 5, decade + 11))
+            ],
+            1000
+        )
+        for i, decade, lines in [
+            (5, 1950, [(27, 78), (92, -3)]),
+            (6, 1960, [(24, 75), (86, -1)])
+        ]
+    },
+    1970: _pep_state_decade_layout(
+        1970, 'st7080ts', [(14, 65), (67, -8)],
+        [
+            [None, 'state'] + list(range(1970, 1976)),
+            [None, 'state'] + list(range(1976, 1981))
+        ],
+        1
+    ),
+    1980: _pep_state_decade_layout(
+        1980, 'st8090ts', [(11, 62), (70, -1)],
+        [
+            ['state'] + list(range(1980, 1985)),
+            ['state'] + list(range(1985, 1991))
+        ],
+        1
+    )
+}
+
+PEP_STATE_1990_LAYOUT = {
+    'url': f'{PEP_TXT_URL}/1990-2000/state/totals/st-99-07.txt',
+    'sections': [{
+        'lines': (28, 79),
+        'fields': [None, 'fips', 'region'] + list(range(1999, 1989, -1)) \
+            + [None]
+    }],
+    'years': (1990, 1999),
+    'scale': 1
+}
+
+PEP_COUNTY_1980_LAYOUT = {
+    'url': f'{PEP_TXT_URL}/1980-1990/counties/totals/e8089co.txt',
+    'blocks': {'lines': (25, r'\s*56045\b'), 'header': r'\s*FIPS\b'},
+    'sections': [
+        {'fields': ['fips', 'region'] + list(range(1980, 1985))},
+        {'fields': ['fips', 'region'] + list(range(1985, 1990))}
+    ],
+    'years': (1980, 1989),
+    'scale': 1
+}
+
+PEP_COUNTY_1990_LAYOUT = {
+    'url': f'{PEP_TXT_URL}/1990-2000/counties/totals/99c8_00.txt',
+    'sections': [{
+        'lines': (12, 3203),
+        'fields': [None, 'fips'] + list(range(1999, 1989, -1)) \
+            + [None, 'region'],
+        # No 1994 estimate for these two counties
+        'overrides': {
+            '49041': [None, 'fips'] + list(range(1999, 1994, -1)) \
+                + [None, None, None] + list(range(1993, 1989, -1)) \
+                + [None, 'region'],
+            '50027': [None, 'fips'] + list(range(1999, 1994, -1)) \
+                + [None, None] + list(range(1993, 1989, -1)) \
+                + [None, 'region']
+        }
+    }],
+    'years': (1990, 1999),
+    'scale': 1
+}
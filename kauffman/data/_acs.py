@@ -1,21 +1,22 @@
 import os
+import requests
+import pandas as pd
+from itertools import product
 from kauffman import constants as c
 from kauffman.tools import api_tools as api
+from kauffman.tools import general_tools as g
 
 
-def _acs_fetch_data(year, var_set, obs_level, state_lst, key, s):
-    var_lst = ','.join(var_set)
+def _acs_fetch_data(group, var_chunks, obs_level, key, s):
+    year, state_lst, chunk = group
+    var_lst = ','.join(var_chunks[chunk])
     base_url = f'https://api.census.gov/data/{year}/acs/acs1?get={var_lst}'
     state_section = ','.join(state_lst)
     
+    # MSAs are requested with a wildcard rather than an explicit list, which
+    # made for urls too long for the API
     in_state = True if obs_level == 'county' else False
-    if obs_level == 'state':
-        fips = state_section
-    elif obs_level == 'msa':
-        msas = [m for state in state_lst for m in c.STATE_TO_MSA_FIPS[state]]
-        fips = ",".join(msas)
-    else:
-        fips = '*'
+    fips = state_section if obs_level == 'state' else '*'
     fips_section = '&for=' \
         + api._fips_section(obs_level, fips, state_section, in_state)
 
@@ -24,9 +25,59 @@ def _acs_fetch_data(year, var_set, obs_level, state_lst, key, s):
     return api.fetch_from_url(url, s).assign(year=year)
 
 
+def _acs_years(s):
+    # Every 1-year ACS release in the API's dataset catalog, rather than a
+    # fixed range, so that new releases (and skipped years) are picked up
+    datasets = api._get(c.ACS_CATALOG_URL, s).json()['dataset']
+    return sorted(
+        int(d['c_vintage']) for d in datasets
+        if d.get('c_dataset') == ['acs', 'acs1'] and 'c_vintage' in d
+    )
+
+
+def _acs_plan(series_lst, obs_level, state_list, years):
+    # Requests are partitioned by year, by state for county-level data, and 
+    # into chunks of variables within the API's per-call variable limit
+    var_chunks = [
+        series_lst[i:i + c.ACS_VAR_LIMIT] 
+        for i in range(0, len(series_lst), c.ACS_VAR_LIMIT)
+    ]
+    state_groups = [[state] for state in state_list] if obs_level == 'county' \
+        else [state_list]
+    groups = [
+        (year, tuple(states), chunk) for year, states, chunk in product(
+            years, state_groups, range(len(var_chunks))
+        )
+    ]
+    return groups, var_chunks
+
+
+def _stitch_chunks(dfs, groups, var_chunks):
+    # The geography and year columns identify the rows of each chunk, so the
+    # chunks are stacked over years and states, then joined side by side
+    chunk_dfs = []
+    for chunk, var_lst in enumerate(var_chunks):
+        df = pd.concat([
+            df for (_, _, df_chunk), df in zip(groups, dfs) 
+            if df_chunk == chunk
+        ])
+        chunk_dfs.append(
+            df.set_index([col for col in df.columns if col not in var_lst])
+        )
+    return pd.concat(chunk_dfs, axis=1).reset_index()
+
+
+def _filter_msas(df, obs_level, state_list):
+    if obs_level != 'msa':
+        return df
+    msas = {m for state in state_list for m in c.STATE_TO_MSA_FIPS[state]}
+    return df[df['fips'].isin(msas)]
+
+
 def acs(
     series_lst='all', obs_level='us', state_lst='all',
-    key=os.getenv("CENSUS_KEY"), n_threads=1
+    key=os.getenv("CENSUS_KEY"), n_threads=1, compact=False,
+    output='pandas', write_to=None
 ):
     """
     Fetches and cleans American Community Survey (ACS) data from the Census's
@@ -76,11 +127,30 @@ def acs(
         Census's data limit is exceeded.
     n_threads: int, default 1
         Number of threads to use for multithreading when fetching the data.
+        The data is requested one year at a time (for every year of the 
+        1-year ACS available in the API), one state at a time for obs_level =
+        'county', and in chunks of at most 50 variables.
         n_threads=1 corresponds to no parallelization, and more threads 
         corresponds to more urls being pulled at a time. The optimal number of
         threads depends on the user's machine and the amount of data being 
         pulled.
+    compact: bool, default False
+        Whether to return the data in a compact schema: categorical
+        identifiers, integer time period codes, and Int32/float32 values. See
+        kauffman.tools.compact_dtypes.
+    output: {'pandas', 'arrow'}, default 'pandas'
+        The type of the returned data. 'arrow' returns a pyarrow.Table with a 
+        stable schema: dictionary-encoded identifiers, an int32 time period 
+        code, and float64 values. Requires pyarrow. See 
+        kauffman.tools.to_arrow. Not available with compact=True.
+    write_to: str, optional
+        A local path or S3 uri to also write the data to, as a Hive-partitioned
+        parquet dataset partitioned by dataset, obs_level, state and year. 
+        Only the partitions covered by this pull are overwritten. Requires 
+        pyarrow. See kauffman.tools.write_dataset.
     """
+    g._check_output(output, compact)
+
     # Handle series_lst
     if series_lst == 'all':
         series_lst = [k for k,v in c.ACS_CODE_TO_VAR.items()]        
@@ -96,15 +166,40 @@ def acs(
         print('WARNING: You did not provide a key. Too many requests will ' \
             'result in an error.')
 
-    years = list(range(2005, 2019 + 1))
-    return api.run_in_parallel(
-            data_fetch_fn = _acs_fetch_data,
-            groups = years,
-            constant_inputs = [series_lst, obs_level, state_list, key],
-            n_threads = n_threads
-        ) \
+    s = requests.Session()
+    groups, var_chunks = _acs_plan(
+        series_lst, obs_level, state_list, _acs_years(s)
+    )
+    dfs = api.run_in_parallel(
+        data_fetch_fn = _acs_fetch_data,
+        groups = groups,
+        constant_inputs = [var_chunks, obs_level, key],
+        n_threads = n_threads,
+        concat = False,
+        session = s
+    )
+    s.close()
+    df = _stitch_chunks(dfs, groups, var_chunks) \
             .pipe(api._create_fips, obs_level) \
+            .pipe(_filter_msas, obs_level, state_list) \
             [['fips', 'region', 'year'] + series_lst] \
             .rename(columns=c.ACS_CODE_TO_VAR) \
             .sort_values(['fips', 'region', 'year']) \
-            .reset_index(drop=True)
\ No newline at end of file
+            .reset_index(drop=True)
+
+    if write_to:
+        g.write_dataset(
+            df, write_to, 'acs', obs_level, 
+            [c.ACS_CODE_TO_VAR.get(s, s) for s in series_lst], time_col='year'
+        )
+    if output == 'arrow':
+        return g.to_arrow(
+            df, [c.ACS_CODE_TO_VAR.get(s, s) for s in series_lst], 
+            time_col='year'
+        )
+    if compact:
+        return g.compact_dtypes(
+            df, [c.ACS_CODE_TO_VAR.get(s, s) for s in series_lst], 
+            time_col='year'
+        )
+    return df
\ No newline at end of file
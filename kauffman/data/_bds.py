@@ -3,17 +3,20 @@ import pandas as pd
 import kauffman.constants as c
 import os
 import numpy as np
+from itertools import product
 from kauffman.tools import api_tools as api
+from kauffman.tools import general_tools as g
 
 
-def _bds_url(variables, obs_level, state_list, strata, key, year):
+def _bds_url(variables, obs_level, geo_list, strata, key, year):
     flag_var = [f'{var}_F' for var in variables]
     var_string = ",".join(variables + strata + flag_var)
-    state_string = ",".join(state_list)
+    geo_string = ",".join(geo_list)
     
-    fips = state_string if obs_level == 'state' else '*'
+    # geo_list holds states, except for MSA data, where it holds MSAs
+    fips = geo_string if obs_level in ['state', 'msa'] else '*'
     in_state = True if obs_level == 'county' else False
-    fips_section = api._fips_section(obs_level, fips, state_string, in_state)
+    fips_section = api._fips_section(obs_level, fips, geo_string, in_state)
 
     naics_string = '&NAICS=00' if 'NAICS' not in strata else ''
     key_section = f'&key={key}' if key else ''
@@ -22,19 +25,78 @@ def _bds_url(variables, obs_level, state_list, strata, key, year):
         f'&for={fips_section}&YEAR={year}{naics_string}{key_section}'
 
 
-def _bds_fetch_data(year, variables, obs_level, state_list, strata, key, s):
-    url = _bds_url(variables, obs_level, state_list, strata, key, year)
-    return api.fetch_from_url(url, s)
+def _bds_years(key, s):
+    key_section = f'&key={key}' if key else ''
+    url = 'https://api.census.gov/data/timeseries/bds?get=FIRM&for=us:*' \
+        f'&YEAR=*&NAICS=00{key_section}'
+    return sorted(api.fetch_from_url(url, s)['YEAR'].unique())
 
 
-def _mark_flagged(df, variables):
-    df[variables] = df[variables] \
-        .apply(
-            lambda x: df[f'{x.name}_F'] \
-                .where(df[f'{x.name}_F'].isin(['D', 'S', 'X']), x) \
-                .replace(['D', 'S', 'X'], np.NaN)
-        )
-    return df  
+def _bds_groups(obs_level, state_list, strata, n_threads, key, s):
+    # A single thread makes one request for every year and geography, unless
+    # the industry detail makes that request too large. Otherwise the data is
+    # partitioned by year, and by state for county data. MSAs are always
+    # requested with a wildcard, so that each year's own delineation is used
+    # rather than a fixed crosswalk.
+    if n_threads == 1 and 'NAICS' not in strata:
+        return [('*', ['*'] if obs_level == 'msa' else state_list)]
+
+    if obs_level == 'county':
+        geo_groups = [[state] for state in state_list]
+    elif obs_level == 'msa':
+        geo_groups = [['*']]
+    else:
+        geo_groups = [state_list]
+    return list(product(_bds_years(key, s), geo_groups))
+
+
+def _bds_fetch_data(group, variables, obs_level, strata, get_flags, key, s):
+    year, geo_list = group
+    url = _bds_url(variables, obs_level, geo_list, strata, key, year)
+    df = api.fetch_from_url(url, s)
+    if df.empty:
+        return df
+
+    # Clean each partition as it arrives, so that the raw string and flag 
+    # columns are never held for the full pull at once
+    return df \
+        .pipe(api._create_fips, obs_level) \
+        .rename(columns={
+            **{'YEAR': 'time', 'NAICS':'naics'}, 
+            **{x:x.lower() for x in strata}
+            }
+        ) \
+        .assign(time=lambda x: pd.to_numeric(x['time'], errors='ignore')) \
+        .pipe(_mark_flagged, variables, get_flags)
+
+
+def _mark_flagged(df, variables, get_flags):
+    # Decode all values and flags as two matrices, so that the masking is done
+    # in a single pass rather than once per variable
+    flag_vars = [f'{var}_F' for var in variables]
+    flags = pd.Categorical(df[flag_vars].to_numpy().ravel())
+    codes = flags.codes.reshape(len(df), len(variables))
+    values = pd.to_numeric(
+            df[variables].to_numpy().ravel(), errors='coerce'
+        ) \
+        .reshape(codes.shape)
+
+    suppressed_codes = flags.categories.get_indexer(['D', 'S', 'X'])
+    suppressed = np.isin(codes, suppressed_codes[suppressed_codes >= 0])
+    df[variables] = np.where(suppressed, np.NaN, values)
+
+    if not get_flags:
+        return df.drop(columns=flag_vars)
+
+    # Flags are kept as categoricals, which store a small-int code per row
+    df[flag_vars] = pd.DataFrame(
+        {
+            var: pd.Categorical.from_codes(codes[:, i], flags.categories)
+            for i, var in enumerate(flag_vars)
+        },
+        index=df.index
+    )
+    return df
 
 
 def check_strata_valid(obs_level, strata):
@@ -59,7 +121,8 @@ def check_strata_valid(obs_level, strata):
 
 def bds(
     series_lst='all', obs_level='us', state_list='all', strata=[], 
-    get_flags=False, key=os.getenv('CENSUS_KEY'), n_threads=1
+    get_flags=False, key=os.getenv('CENSUS_KEY'), n_threads=1, compact=False,
+    output='pandas', write_to=None
 ):
     """
     Fetches and cleans Business Dynamics Statistics (BDS) data from the Census's
@@ -157,18 +220,37 @@ def bds(
     get_flags: bool, default False
         Whether to include the variables that hold the data flags. Note that the
         information in these variables is already placed inside the original
-        variables as a part of the data-cleaning process.
+        variables as a part of the data-cleaning process. The flag variables
+        are returned as categoricals.
     key: str, default os.getenv("CENSUS_KEY"), optional
         Census API key. See README for instructions on how to get one, if 
         desired. Otherwise, user can pass key=None, which will work until the
         Census's data limit is exceeded.
     n_threads: int, default 1
         Number of threads to use for multithreading when fetching the data.
-        n_threads=1 corresponds to no parallelization, and more threads 
-        corresponds to more urls being pulled at a time. The optimal number of
-        threads depends on the user's machine and the amount of data being 
-        pulled.
+        n_threads=1 corresponds to no parallelization, with all of the data
+        requested at once (one year at a time if 'NAICS' is in strata). With 
+        more threads, the data is requested one year at a time (and one state
+        at a time, for obs_level = 'county'), with that many urls being 
+        pulled at a time. The optimal number of threads depends on the 
+        user's machine and the amount of data being pulled.
+    compact: bool, default False
+        Whether to return the data in a compact schema: categorical
+        identifiers, integer time period codes, and Int32/float32 values. See
+        kauffman.tools.compact_dtypes.
+    output: {'pandas', 'arrow'}, default 'pandas'
+        The type of the returned data. 'arrow' returns a pyarrow.Table with a 
+        stable schema: dictionary-encoded identifiers, an int32 time period 
+        code, and float64 values. Requires pyarrow. See 
+        kauffman.tools.to_arrow. Not available with compact=True.
+    write_to: str, optional
+        A local path or S3 uri to also write the data to, as a Hive-partitioned
+        parquet dataset partitioned by dataset, obs_level, state and year. 
+        Only the partitions covered by this pull are overwritten. Requires 
+        pyarrow. See kauffman.tools.write_dataset.
     """
+    g._check_output(output, compact)
+
     series_list = c.BDS_SERIES if series_lst == 'all' else series_lst
 
     state_list = c.STATES if state_list == 'all' else state_list
@@ -207,38 +289,41 @@ def bds(
         print('WARNING: You did not provide a key. Too many requests will ' \
             'result in an error.')
 
-    # Data fetch
-    if 'NAICS' not in strata or obs_level == 'us':
-        url = _bds_url(series_list, obs_level, state_list, strata, key, '*')
-        df = api.fetch_from_url(url, requests)
-    else:
-        years = list(range(1978, 2020))
-        df = api.run_in_parallel(
-            data_fetch_fn = _bds_fetch_data,
-            groups = years,
-            constant_inputs = [series_list, obs_level, state_list, strata, key],
-            n_threads = n_threads
-        )
+    s = requests.Session()
+    df = api.run_in_parallel(
+        data_fetch_fn = _bds_fetch_data,
+        groups = _bds_groups(
+            obs_level, state_list, strata, n_threads, key, s
+        ),
+        constant_inputs = [series_list, obs_level, strata, get_flags, key],
+        n_threads = n_threads,
+        session = s
+    )
+    s.close()
 
     flags = [f'{var}_F' for var in series_list] if get_flags else []
+    if df.empty:
+        # Every request came back without content
+        df = pd.DataFrame(
+            columns=['fips', 'region', 'time', 'naics'] \
+                + [x.lower() for x in strata] + series_list + flags
+        )
 
-    return df \
-        .pipe(api._create_fips, obs_level) \
-        .rename(columns={
-            **{'YEAR': 'time', 'NAICS':'naics'}, 
-            **{x:x.lower() for x in strata}
-            }
-        ) \
+    df = df \
         .assign(industry=lambda x: x['naics'].map(c.NAICS_CODE_TO_ABB(2))) \
-        .apply(
-            lambda x: pd.to_numeric(x, errors='ignore') \
-                if x.name in series_list + ['time'] else x
-        ) \
-        .pipe(_mark_flagged, series_list) \
+        .astype({flag:'category' for flag in flags}) \
         .sort_values(['fips', 'time'] + [x.lower() for x in strata]) \
         .reset_index(drop=True) \
         [
             ['fips', 'region', 'time'] \
             + [x.lower() for x in strata] \
             + series_list + flags
-        ]
\ No newline at end of file
+        ]
+
+    if write_to:
+        g.write_dataset(df, write_to, 'bds', obs_level, series_list)
+    if output == 'arrow':
+        return g.to_arrow(df, series_list)
+    if compact:
+        return g.compact_dtypes(df, series_list)
+    return df
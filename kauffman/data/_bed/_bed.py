@@ -1,10 +1,46 @@
 import pandas as pd
 import kauffman.constants as c
+from kauffman.tools import api_tools as api
+from kauffman.tools import general_tools as g
+from kauffman.tools import time_tools as t
 from ._firm_size import firm_size_data
 from ._est_age_surv import est_age_surv_data
 
 
-def bed(series, table, obs_level='us', state_list='all', industry='00'):
+def _fetch_source(job, series, industry, store, age, size, s):
+    table, group = job
+    if series in ['firm size', 'size']:
+        return firm_size_data(group, table, s)
+    return est_age_surv_data(group, table, industry, store, s, age, size)
+
+
+def _finish(df, annualize, compact, output, write_to, dataset, obs_level):
+    if annualize:
+        df = t.aggregate_periods(
+                df, ['fips', 'region', 'size'], c.BED_TABLE_FIRM_SIZE_COLS[2:],
+                period_col='quarter', drop_incomplete=True
+            ) \
+            [['fips', 'region', 'time', 'size'] + c.BED_TABLE_FIRM_SIZE_COLS[2:]]
+
+    id_cols = [
+        'fips', 'region', 'time', 'quarter', 'size', 'industry', 'age', 
+        'age_class'
+    ]
+    value_cols = [col for col in df.columns if col not in id_cols]
+    if write_to:
+        g.write_dataset(df, write_to, dataset, obs_level, value_cols)
+    if output == 'arrow':
+        return g.to_arrow(df, value_cols)
+    if compact:
+        return g.compact_dtypes(df, value_cols)
+    return df
+
+
+def bed(
+    series, table, obs_level='us', state_list='all', industry='00', 
+    compact=False, annualize=False, store=True, n_threads=1, output='pandas',
+    write_to=None, age=0, size=7
+):
     """
     Fetch and clean Business Employment Dynamics (BED) data from 
     https://www.bls.gov/bdm.
@@ -19,8 +55,10 @@ def bed(series, table, obs_level='us', state_list='all', industry='00'):
                 1: 1-4 , 2: 5-9 , 3: 10-19 , 4: 20-49 , 5: 50-99, 6: 100-249 ,
                 7: 250-499 , 8: 500-999 , 9: >1000
 
-    table: {1, 2, 3, 4, 5, 6, 7, '1bf'}
-        The table of data to retrieve. Tables differ between series.
+    table: {1, 2, 3, 4, 5, 6, 7, '1bf'} or list
+        The table of data to retrieve. Tables differ between series. If a list
+        is given, a dict mapping each table to its data is returned, and the
+        source files of all the tables are fetched together, each one once.
 
         --Establishment Age and Survival--
         1: Private sector gross jobs gains and losses by establishment age
@@ -35,7 +73,8 @@ def bed(series, table, obs_level='us', state_list='all', industry='00'):
         6: Private sector employment by establishment age
         7: Survival of private sector establishments by opening year
         1bf: Annual gross job gains and gross job losses by age and base
-            size of firm
+            size of firm, for the age and size given by the age and size 
+            parameters
 
         --Firm Size--
         Private Sector Firm-Level Job Gains and Losses
@@ -74,17 +113,97 @@ def bed(series, table, obs_level='us', state_list='all', industry='00'):
         71: Arts, entertainment, and recreation
         72: Accommodation and food services
         81: Other services (except public administration)
+    compact: bool, default False
+        Whether to return the data in a compact schema: categorical
+        identifiers, integer time period codes, and Int32/float32 values. See
+        kauffman.tools.compact_dtypes.
+    annualize: bool, default False
+        Whether to aggregate the quarterly job flows to the annual level. Only 
+        available for series = 'firm size', tables 1 and 2. Years without all 
+        four quarters are dropped.
+    store: bool, default True
+        Whether to read release-stamped source files (table '1bf') from the 
+        local vintage store, building it on first use. See 
+        kauffman.tools.load_vintage.
+    n_threads: int, default 1
+        Number of threads to use for multithreading when fetching the data.
+        The files are requested one firm size at a time (series = 'firm 
+        size') or one state at a time (series = 'establishment age and 
+        survival'), for all tables at once, over a shared session, with 
+        retries. n_threads=1 corresponds to no parallelization.
+    output: {'pandas', 'arrow'}, default 'pandas'
+        The type of the returned data. 'arrow' returns a pyarrow.Table (or a 
+        dict of them) with a stable schema: dictionary-encoded identifiers, 
+        an int32 time period code, and float64 values. Requires pyarrow. See 
+        kauffman.tools.to_arrow. Not available with compact=True.
+    write_to: str, optional
+        A local path or S3 uri to also write the data to, as a Hive-partitioned
+        parquet dataset partitioned by dataset, obs_level, state and year. 
+        Each table is its own dataset, named 'bed_<age or size>_<table>'. Only
+        the partitions covered by this pull are overwritten. Requires pyarrow.
+        See kauffman.tools.write_dataset.
+    age: int or 'all', default 0
+        The firm age to fetch. Only available for table '1bf'. If 'all',
+        every age is returned, identified by the age column.
+
+        --Options--
+        0: Less than one year old
+        1: 1 to 4 years
+        2: 5 to 9 years
+        3: 10 years or older
+        4: All
+    size: int or 'all', default 7
+        The base size of firm to fetch. Only available for table '1bf'. If
+        'all', every size is returned, identified by the size column.
+
+        --Options--
+        0: 1 to 4 employees
+        1: 5 to 9 employees
+        2: 10 to 19 employees
+        3: 20 to 49 employees
+        4: 50 to 99 employees
+        5: 100 to 499 employees
+        6: 500 or more employees
+        7: All
     """
+    g._check_output(output, compact)
+
     state_list = c.STATES if state_list == 'all' else state_list    
     region_list = state_list if obs_level == 'state' else ['us']
+    table_list = list(dict.fromkeys(table if type(table) == list else [table]))
 
     if series in ['firm size', 'size']:
-        return pd.concat([
-                firm_size_data(table, size)
-                for size in range(1, 10)
-            ])
+        group_list, series_name = range(1, 10), 'size'
     elif series in ['establishment age and survival', 'age']:
-        return pd.concat([
-                est_age_surv_data(table, region, industry)
-                for region in region_list
-            ])
\ No newline at end of file
+        group_list, series_name = region_list, 'age'
+    else:
+        raise Exception(f'Invalid series: {series}')
+
+    if annualize and (
+        series not in ['firm size', 'size'] 
+        or any(tab not in [1, 2] for tab in table_list)
+    ):
+        raise Exception(
+            'annualize is only available for series = "firm size", '
+            'tables 1 and 2.'
+        )
+
+    # One job per distinct source file, so every file is downloaded and parsed
+    # once, concurrently with the files of the other tables
+    jobs = [(tab, group) for tab in table_list for group in group_list]
+    dfs = api.run_in_parallel(
+        _fetch_source, jobs, [series, industry, store, age, size], n_threads, 
+        concat=False
+    )
+
+    tables = {
+        tab:_finish(
+            pd.concat([
+                df for (job_tab, _), df in zip(jobs, dfs) if job_tab == tab
+            ]),
+            annualize, compact, output, write_to, f'bed_{series_name}_{tab}', 
+            obs_level
+        )
+        for tab in table_list
+    }
+    return tables if type(table) == list else tables[table]
\ No newline at end of file
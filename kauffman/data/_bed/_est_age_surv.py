@@ -1,232 +1,255 @@
-import requests
+import openpyxl
 import numpy as np
 import pandas as pd
 import kauffman.constants as c
+from io import BytesIO
+from kauffman.tools import api_tools as api
+from kauffman.tools import vintage_tools as v
 
 
-def _data_lines_survival(table, region, industry):
+def _data_lines_survival(table, region, industry, s):
     if region == 'us':
         url = 'https://www.bls.gov/bdm/us_age_naics_' \
             + f'{industry}_table{table}.txt'
     else:
         url = f'https://www.bls.gov/bdm/{region}_age_total_table{table}.txt'
-    return requests.get(url).text.split('\n')
+    return api._get(url, s).text.split('\n')
 
 
-def _format_covars1(df):
-    return df \
-        .replace('N', np.nan) \
-        .assign(
-            net_change=lambda x: x['net_change'].str.replace(',', ''),
-            total_gains=lambda x: x['total_gains'].str.replace(',', ''),
-            gross_job_gains_expanding_ests=lambda x: \
-                x['gross_job_gains_expanding_ests'].str.replace(',', ''),
-            gross_job_gains_opening_ests=lambda x: \
-                x['gross_job_gains_opening_ests'].str.replace(',', ''),
-            total_losses=lambda x: x['total_losses'].str.replace(',', ''),
-            gross_job_losses_contracting_ests=lambda x: \
-                x['gross_job_losses_contracting_ests'].str.replace(',', ''),
-            gross_job_losses_closing_ests=lambda x: \
-                x['gross_job_losses_closing_ests'].str.replace(',', ''),
-        ) \
-        .astype(
-            {
-                'time': 'int',
-                'net_change': 'float',
-                'total_gains': 'float',
-                'gross_job_gains_expanding_ests': 'float',
-                'gross_job_gains_opening_ests': 'float',
-                'total_losses': 'float',
-                'gross_job_losses_contracting_ests': 'float',
-                'gross_job_losses_closing_ests': 'float',
-            }
-        )
-
-
-def _to_float(x):
-    try:
-        return float(x)
-    except:
-        return np.nan
-
-
-def _format_covars7(df):
-    return df \
-        .assign(
-            establishments=lambda x: x['establishments'].str.replace(',', ''),
-            employment=lambda x: x['employment'].str.replace(',', ''),
-            survival_previous_year=lambda x: x['survival_previous_year'] \
-                .str.replace('_', '').apply(_to_float),  
-                # I have no idea why I can't "astype" this column
-        ) \
-        .astype(
-            {
-                'time': 'int',
-                'end_year': 'int',
-                'establishments': 'int',
-                'employment': 'int',
-                'survival_since_birth': 'float',
-            }
-        )
-
-
-def table1(lines):
-    cohort = 1994
-    age = 1
-    data_lst = []
-    for ind, line in enumerate(lines[9:-2]):
-        if 'Less than one year' in line:
-            data_lst.append([cohort] + ['age 0'] + line.split()[-7:])
-        if 'Born before March' in line:
-            data_lst.append([cohort] + ['pre 1993'] + line.split()[-7:])
-        if 'Total' in line:
-            data_lst.append([cohort] + ['total'] + line.split()[-7:])
-            cohort += 1
-            age = 1
-        if '{} year'.format(age) in line:
-            data_lst.append(
-                [cohort] + ['age {}'.format(age)] + line.split()[-7:]
-            )
-            age += 1
-
-    return pd.DataFrame(
-            data_lst,
-            columns=[
-                'time', 'age', 'net_change', 'total_gains', 
-                'gross_job_gains_expanding_ests', 
-                'gross_job_gains_opening_ests', 'total_losses', 
-                'gross_job_losses_contracting_ests', 
-                'gross_job_losses_closing_ests'
-            ]
+def _classify_lines(lines):
+    # A single regex pass labels each line (age class, cohort total, etc.) and
+    # keeps the text that follows the label, with thousands separators removed
+    return pd.Series(lines, dtype='object') \
+        .str.replace(',', '', regex=False) \
+        .str.extract(
+            r'(?P<label>Less than one year|Born before March \d{4}|Total'
+            r'|(?P<age>\d+) years?\b)(?P<rest>.*)$'
         ) \
-        .pipe(_format_covars1)
-
-
-def table5(lines):
-    cohort = 1994
-    age = 1
-    df_out = pd.DataFrame(columns=['age_class'])
-    for ind, line in enumerate(lines[6:-2]):
-        if 'Less than one year' in line:
-            data_lst = []
-            data_lst.append(['Less than one year'] + line.split()[4:])
-        if '{} year'.format(age) in line:
-            data_lst.append(
-                ['{age} {year}'.format(
-                    age=age, year='year' if age == 1 else 'years'
-                )] \
-                + line.split()[2:]
-            )
-            age += 1
-        if 'Born before March' in line:
-            data_lst.append(['Born before March 1993'] + line.split()[4:])
-        if 'Total' in line:
-            data_lst.append(line.split())
-            df_out = df_out.merge(
-                pd.DataFrame(
-                    data_lst, 
-                    columns=['age_class'] \
-                        + list(range(cohort, cohort + len(data_lst[0]) - 1))
-                ), how='right', on='age_class'
-            )
-            age = 1
-            cohort += 6
-    return df_out
+        .dropna(subset=['label']) \
+        .reset_index(drop=True)
 
 
-def table7(lines):
-    cohort = 1994
-    data_lst = []
-    for ind, line in enumerate(lines[11:-2]):
-        if (not line.split()) or ('openings' in line) or ('ended' in line):
-            continue
-        data_lst.append([cohort] + line.split()[1:])
-        if 'March 2021' in line:  # this needs to be incremented yearly
-            cohort += 1
-
-    return pd.DataFrame(
-            data_lst,
-            columns=[
-                'time', 'end_year', 'establishments', 'employment', 
-                'survival_since_birth', 'survival_previous_year', 'average_emp'
-            ]
-        ) \
-        .pipe(_format_covars7) \
-        .assign(age=lambda x: x['end_year'] - x['time'])
+def _tokens_pattern(names):
+    return r'\s+'.join([f'(?P<{name}>\\S+)' for name in names]) + r'\s*$'
 
 
-def _extract_rows(df, age, size):
-    # todo: make this table title dynamic
-    title = 'Table 1-B-F: Annual gross job gains and gross job ' \
-        'losses by age and base size of firm'
-    
-    mask = df[title] == title
-    ind_lst = df.index[mask].tolist()
+def _last_tokens(x, names):
+    return x.str.extract(r'(?:^|\s)' + _tokens_pattern(names))
 
-    num_rows = ind_lst[1] - ind_lst[0] - 1
-    ind = ind_lst[c.BED_AGE_SIZE_LIST.index((age, size))]
 
-    return df.iloc[(ind - num_rows) + 4:ind]
+def _cohort_blocks(df):
+    # The number of cohort totals above each line
+    is_total = df['label'] == 'Total'
+    return (is_total.cumsum() - is_total).to_numpy()
 
 
-def _remove_trailing_rows(df):
-    title = 'Table 1-B-F: Annual gross job gains and gross job ' \
-        'losses by age and base size of firm'
+def table1(lines):
+    covars = [
+        'net_change', 'total_gains', 'gross_job_gains_expanding_ests', 
+        'gross_job_gains_opening_ests', 'total_losses', 
+        'gross_job_losses_contracting_ests', 'gross_job_losses_closing_ests'
+    ]
+    df = _classify_lines(lines[9:-2])
+    return pd.concat(
+        [
+            pd.DataFrame({
+                'time':1994 + _cohort_blocks(df),
+                'age':np.select(
+                    [
+                        df['label'] == 'Less than one year',
+                        df['label'].str.startswith('Born before March'),
+                        df['label'] == 'Total'
+                    ],
+                    ['age 0', 'pre 1993', 'total'],
+                    'age ' + df['age'].fillna('')
+                )
+            }),
+            _last_tokens(df['rest'], covars) \
+                .replace('N', np.nan) \
+                .astype('float')
+        ],
+        axis=1
+    )
 
-    last_year_ind = df.index[df[title] == 2021].tolist()[0]
-    return df.loc[:last_year_ind].reset_index(drop=True)
 
+def table5(lines):
+    df = _classify_lines(lines[6:-2])
+    df = df.assign(
+        block=_cohort_blocks(df),
+        age_class=np.select(
+            [
+                df['age'] == '1',
+                df['age'].notna(),
+                df['label'].str.startswith('Born before March')
+            ],
+            [
+                '1 year',
+                df['age'] + ' years',
+                'Born before March 1993'
+            ],
+            df['label']
+        ),
+        value=df['rest'].str.split()
+    )
+
+    # Each block of lines covers six years, one per value column, so the long
+    # format is emitted directly instead of merging the blocks together
+    df = df[['block', 'age_class', 'value']].explode('value')
+    df = df \
+        .assign(
+            time=lambda x: 1994 + 6 * x['block'] \
+                + x.groupby(level=0).cumcount(),
+            establishments=lambda x: pd.to_numeric(
+                x['value'], errors='coerce'
+            )
+        ) \
+        .dropna(subset=['value'])
 
-def _column_headers(df):
-    df.columns = c.BED_TABLE1BF_COLS
-    return df
+    age_classes = df.loc[df['block'] == df['block'].max(), 'age_class'] \
+        .unique()
+    return df \
+        .set_index(['age_class', 'time']) \
+        ['establishments'] \
+        .reindex(
+            pd.MultiIndex.from_product(
+                [age_classes, sorted(df['time'].unique())], 
+                names=['age_class', 'time']
+            )
+        ) \
+        .reset_index()
 
 
-def _values_fix(df):
+def table7(lines):
+    covars = [
+        'end_year', 'establishments', 'employment', 'survival_since_birth', 
+        'survival_previous_year', 'average_emp'
+    ]
+    rows = pd.Series(lines[11:-2], dtype='object')
+    rows = rows[
+        rows.str.strip().astype(bool) \
+        & ~rows.str.contains('openings|ended')
+    ]
+    df = rows \
+        .str.replace(',', '', regex=False) \
+        .str.extract(r'^\s*\S+\s+' + _tokens_pattern(covars)) \
+        .apply(pd.to_numeric, errors='coerce') \
+        .reset_index(drop=True)
+
+    # Each cohort's rows run through the latest year, so a new cohort starts
+    # wherever end_year stops increasing
     return df \
-        .replace('_', np.nan, regex=True) \
-        .replace('N', np.nan, regex=True) \
+        .assign(time=1994 + (df['end_year'].diff() <= 0).cumsum()) \
+        .astype({'end_year':'int', 'establishments':'int', 'employment':'int'}) \
+        .assign(age=lambda x: x['end_year'] - x['time']) \
+        [['time'] + covars + ['age']]
+
+
+def _is_year(x):
+    return str(x).strip().isdigit() and len(str(x).strip()) == 4
+
+
+def _workbook_blocks(rows):
+    # Each (age, size) block follows a repeat of the table title (the first 
+    # cell of the sheet) and four header rows, and its data runs through the
+    # rows with a year in the first column
+    blocks, block = [], None
+    title = None
+    for row in rows:
+        if title is None:
+            title = row[0]
+        if row[0] == title:
+            block = []
+            blocks.append(block)
+        elif block is not None:
+            block.append(row)
+    return [
+        [row for row in block[4:] if _is_year(row[0])] for block in blocks
+    ]
+
+
+def _blocks_to_frame(blocks):
+    n_cols = len(c.BED_TABLE1BF_COLS)
+    return pd.concat([
+            pd.DataFrame(
+                    [row[:n_cols] for row in block], 
+                    columns=c.BED_TABLE1BF_COLS
+                ) \
+                .assign(
+                    age=c.AGE_CODE_TO_LABEL[age], 
+                    size=c.BED_SIZE_CODE_TO_LABEL[size]
+                )
+            for block, (age, size) in zip(blocks, c.BED_AGE_SIZE_LIST)
+        ]) \
+        .replace(r'^\s*[_N]\s*$', np.nan, regex=True) \
         .replace(',', '', regex=True) \
         .astype(dict(
-            zip(c.BED_TABLE1BF_COLS[1:], [float] * len(c.BED_TABLE1BF_COLS[1:]))
-        ))
-
-
-def table1bf(df, age=0, size=7):  
-    # todo: make age and size variables in kauffman.bed()
-    return df \
-        .pipe(_extract_rows, age, size) \
-        .pipe(_remove_trailing_rows) \
-        .pipe(_column_headers) \
-        .pipe(_values_fix)
+            zip(c.BED_TABLE1BF_COLS, ['int'] + [float] * (n_cols - 1))
+        )) \
+        [['time', 'age', 'size'] + c.BED_TABLE1BF_COLS[1:]] \
+        .reset_index(drop=True)
+
+
+def table1bf(content):
+    # The workbook is streamed once in read-only mode, and every (age, size)
+    # block is kept rather than just the one requested
+    wb = openpyxl.load_workbook(
+        BytesIO(content), read_only=True, data_only=True
+    )
+    blocks = _workbook_blocks(wb.worksheets[0].iter_rows(values_only=True))
+    wb.close()
+    return _blocks_to_frame(blocks)
+
+
+def _fetch_table1bf(url, s):
+    return table1bf(api._get(url, s).content)
+
+
+def _select_blocks(df, age, size):
+    # A single age or size drops its column, as in the one-block table
+    for col, code, labels in [
+        ('age', age, c.AGE_CODE_TO_LABEL), 
+        ('size', size, c.BED_SIZE_CODE_TO_LABEL)
+    ]:
+        if code == 'all':
+            continue
+        if code not in labels:
+            raise Exception(f'Invalid {col} code: {code}')
+        df = df[df[col] == labels[code]].drop(columns=col)
+    return df.reset_index(drop=True)
 
 
-def est_age_surv_data(table, region, industry):
+def est_age_surv_data(region, table, industry, store, s, age=0, size=7):
     if table in range(1, 5):
-        df = table1(_data_lines_survival(table, region, industry))
+        df = table1(_data_lines_survival(table, region, industry, s))
     if table in [5, 6]:
-        df = table5(_data_lines_survival(table, region, industry)) \
-            .pipe(
-                pd.melt, id_vars=['age_class'], var_name='time', 
-                value_name='establishments'
-            ) \
+        df = table5(_data_lines_survival(table, region, industry, s)) \
             .assign(industry=industry) \
-            .replace({'_':np.NaN}) \
             [['time', 'industry', 'age_class', 'establishments']]
     if table == 7:
-        df = table7(_data_lines_survival(table, region, industry))
+        df = table7(_data_lines_survival(table, region, industry, s))
     if table == '1bf':
         url = 'https://www.bls.gov/bdm/age_by_size/' \
             + ("" if region == "us" else f"{region}_") \
             + 'age_naics_base_ein_20211_t1.xlsx'
-        df = table1bf(pd.read_excel(url, engine='openpyxl'))
+        # The url is stamped with the release, so its parsed table is final
+        if store:
+            name = 'bed/' + url.split('/')[-1].replace('.xlsx', '')
+            df = v.load_vintage(
+                name, _fetch_table1bf, [url, s], 
+                version=c.BED_VINTAGE_VERSION
+            )
+        else:
+            df = _fetch_table1bf(url, s)
+        df = _select_blocks(df, age, size)
 
+    # The sort is stable, so the rows of each year keep their source order
+    # (for table 1bf, the age and size blocks)
     covars = df.columns.tolist()[1:]
     return df \
         .assign(
             region=c.STATE_ABB_TO_NAME[region.upper()],
             fips=c.STATE_ABB_TO_FIPS[region.upper()]
         ) \
-        .sort_values(['fips', 'time']) \
+        .sort_values(['fips', 'time'], kind='stable') \
         .reset_index(drop=True) \
         [['fips', 'region', 'time'] + covars]
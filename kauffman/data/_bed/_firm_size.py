@@ -1,11 +1,12 @@
-import requests
 import pandas as pd
 import kauffman.constants as c
+from kauffman.tools import api_tools as api
+from kauffman.tools import time_tools as t
 
 
-def _data_lines_firmsize(table, firm_size):
+def _data_lines_firmsize(table, firm_size, s):
     url = f'https://www.bls.gov/web/cewbd/f.0{firm_size}.table{table}_d.txt'
-    lines = requests.get(url).text.split('\n')
+    lines = api._get(url, s).text.split('\n')
     return lines
 
 
@@ -31,13 +32,13 @@ def df_create(lines):
     return df
 
 
-def firm_size_data(table, firm_size):
-    return df_create(_data_lines_firmsize(table, firm_size)) \
+def firm_size_data(firm_size, table, s):
+    return df_create(_data_lines_firmsize(table, firm_size, s)) \
         .assign(
             size=c.BED_SIZE_CODE_TO_LABEL2[firm_size],
             fips='00',
             region='US',
-            quarter=lambda x: x['quarter'].map(c.MONTH_TO_QUARTER)
+            quarter=lambda x: t.month_to_period(x['quarter'])
         ) \
         [
             ['fips', 'region', 'time', 'quarter', 'size']
@@ -1,78 +1,176 @@
+import os
+import csv
+import json
 import pandas as pd
 import numpy as np
 from kauffman import constants as c
+from kauffman.tools import api_tools as api
+from kauffman.tools import general_tools as g
+from kauffman.tools import time_tools as t
 from zipfile import ZipFile
-from io import BytesIO
+from io import BytesIO, TextIOWrapper
 import urllib.request as urllib2
 
 
-def _format_df(df):
-    df.columns = df.iloc[1]
-    return df.dropna(axis=1, how='all') \
-        .iloc[2:]
+def _section_rows(f, names):
+    # Reads the rows of the key sections, stopping at the DATA section header
+    # so that the rest of the stream can be handed straight to read_csv
+    sections = {}
+    section = None
+    while True:
+        line = f.readline()
+        if not line:
+            return sections
+        row = next(csv.reader([line]), [])
+        if row and row[0] in names:
+            section = row[0]
+            if section == 'DATA':
+                return sections
+            sections[section] = []
+        elif section and any(row):
+            sections[section].append(row)
 
-	
-def _fetch_data():
-    link = 'https://www.census.gov/econ_getzippedfile/?programCode=BFS'
-    r = urllib2.urlopen(link).read()
-    file = ZipFile(BytesIO(r)) 
-    bfs_file = file.open("BFS-mf.csv")
 
-    df = pd.read_csv(
-        bfs_file, names=['a', 'b', 'c', 'd', 'e', 'f'], dtype='str'
-    )
-    names = [
-        'CATEGORIES', 'DATA TYPES', 'GEO LEVELS', 'TIME PERIODS', 'NOTES',
-        'DATA'
-    ]
-    row_splits = list(df.query(f'a in {names}').index)
+def _lookup(rows, idx_col, value_col):
+    header, body = rows[0], rows[1:]
+    idx, value = header.index(idx_col), header.index(value_col)
+    lookup = np.empty(max(int(row[idx]) for row in body) + 1, dtype=object)
+    for row in body:
+        lookup[int(row[idx])] = row[value]
+    return lookup
+
 
-    industry_key, series_key, region_key, time_key = [
-        df[row_splits[i]:row_splits[i+1]] \
-            .pipe(_format_df)
-        for i in range(0,4)
+def _keep(lookup, values):
+    return np.ones(len(lookup), dtype=bool) if values is None \
+        else np.isin(lookup, values)
+
+
+def _filter_chunk(df, keep_geo, keep_cat, keep_series_adj):
+    return df[
+        keep_geo[df['geo_idx'].to_numpy()] \
+        & keep_cat[df['cat_idx'].to_numpy()] \
+        & keep_series_adj[df['dt_idx'].to_numpy(), df['is_adj'].to_numpy()]
     ]
-    data = _format_df(df[row_splits[-1]:])
 
-    return data, industry_key, series_key, region_key, time_key
-	
 
-def clean_data(df, industry_key, series_key, region_key, time_key):
-    df = df \
-        .merge(
-            industry_key.drop(columns='cat_indent'), on='cat_idx', how='left'
-        ) \
-        .merge(series_key[['dt_idx', 'dt_code']], on='dt_idx', how='left') \
-        .merge(region_key, on='geo_idx', how='left') \
-        .merge(time_key, on='per_idx', how='left') \
-        .rename(
-            columns={
-                'cat_code':'naics', 'cat_desc':'industry', 'dt_code':'series', 
-                'geo_code':'region_code', 'geo_desc':'region', 'per_name':'time'
-            }
+def _parse_bfs_file(
+    f, region_list=None, industry_list=None, series_to_adj=None
+):
+    sections = _section_rows(
+        f, 
+        ['CATEGORIES', 'DATA TYPES', 'GEO LEVELS', 'TIME PERIODS', 'NOTES', 
+            'DATA']
+    )
+    naics = pd.Series(_lookup(sections['CATEGORIES'], 'cat_idx', 'cat_code')) \
+        .str.replace('NAICS', '') \
+        .replace({
+            'TOTAL':'00', 'TW':'48-49', 'RET':'44-45', 'MNF':'31-33', 'NO':'ZZ'
+        }) \
+        .to_numpy()
+    industry = _lookup(sections['CATEGORIES'], 'cat_idx', 'cat_desc')
+    series = _lookup(sections['DATA TYPES'], 'dt_idx', 'dt_code')
+    region_code = _lookup(sections['GEO LEVELS'], 'geo_idx', 'geo_code')
+    region = _lookup(sections['GEO LEVELS'], 'geo_idx', 'geo_desc')
+    time = pd.to_datetime(
+            pd.Series(_lookup(sections['TIME PERIODS'], 'per_idx', 'per_name')),
+            format='%b-%Y'
         ) \
+        .to_numpy()
+
+    # Filters are pushed down to the data section as boolean lookups on the
+    # integer codes, so only the requested slice is ever materialized. Every
+    # requested series gets a column, even if the slice has no rows for it
+    if series_to_adj is None:
+        keep_series_adj = np.ones((len(series), 2), dtype=bool)
+    else:
+        keep_series_adj = np.column_stack([
+            np.isin(series, [s for s, adj in series_to_adj.items() if adj == 0]),
+            np.isin(series, [s for s, adj in series_to_adj.items() if adj == 1])
+        ])
+    reader = pd.read_csv(
+        f, 
+        dtype={
+            'per_idx':'int32', 'cat_idx':'int32', 'dt_idx':'int32', 
+            'geo_idx':'int32', 'is_adj':'int8', 'val':'str'
+        },
+        chunksize=c.BFS_CHUNKSIZE
+    )
+    df = pd.concat([
+            _filter_chunk(
+                chunk, _keep(region_code, region_list), 
+                _keep(naics, industry_list), keep_series_adj
+            )
+            for chunk in reader
+        ]) \
+        .assign(val=lambda x: pd.to_numeric(x['val'], errors='coerce')) \
+        .set_index(['per_idx', 'geo_idx', 'cat_idx', 'is_adj', 'dt_idx']) \
+        ['val'] \
+        .unstack('dt_idx') \
+        .reindex(columns=np.flatnonzero(
+            keep_series_adj.any(axis=1) & (series != None)
+        )) \
+        .reset_index()
+    df.columns = [
+        series[col] if type(col) != str else col for col in df.columns
+    ]
+    df.columns.name = None
+
+    return df \
         .assign(
-            naics=lambda x: x.naics.str.replace('NAICS', '') \
-                .replace({
-                    'TOTAL':'00', 'TW':'48-49', 'RET':'44-45', 'MNF':'31-33', 
-                    'NO':'ZZ'
-                }),
+            time=lambda x: time[x['per_idx']],
+            region=lambda x: region[x['geo_idx']],
+            region_code=lambda x: region_code[x['geo_idx']],
+            industry=lambda x: industry[x['cat_idx']],
+            naics=lambda x: naics[x['cat_idx']]
         ) \
-        .pivot(
-            index=[
-                'time', 'region', 'region_code', 'industry', 'naics', 'is_adj'
-            ],
-            columns='series', values='val'
-        ) \
-        .reset_index() \
-        .replace({'D':np.NaN, 'S':np.NaN}) \
-        .apply(pd.to_numeric, errors='ignore')
-        
-    df.columns.name = None
+        .drop(columns=['per_idx', 'geo_idx', 'cat_idx'])
+
+
+def _filter_parsed(df, region_list, industry_list, series_to_adj):
+    return df[
+        df['region_code'].isin(region_list) \
+        & df['naics'].isin(industry_list) \
+        & df['is_adj'].isin(set(series_to_adj.values()))
+    ]
+
+
+def _cached_table():
+    # The full parsed table is cached next to the archive and is only
+    # rebuilt when the archive itself has been replaced by a new release, or
+    # when it was written by another version of the parser
+    archive_path = api.cached_download(
+        c.BFS_URL, os.path.join(c.CACHE_DIR, 'bfs', 'BFS.zip')
+    )
+    table_path = os.path.join(c.CACHE_DIR, 'bfs', 'BFS.pkl')
+    meta_path = table_path + '.json'
+    if os.path.exists(table_path) and os.path.exists(meta_path) \
+        and os.path.getmtime(table_path) >= os.path.getmtime(archive_path):
+        with open(meta_path) as f:
+            if json.load(f).get('version') == c.BFS_TABLE_VERSION:
+                return pd.read_pickle(table_path)
 
+    with ZipFile(archive_path).open("BFS-mf.csv") as bfs_file:
+        df = _parse_bfs_file(TextIOWrapper(bfs_file, encoding='utf-8'))
+    df.to_pickle(table_path + '.tmp')
+    os.replace(table_path + '.tmp', table_path)
+    with open(meta_path, 'w') as f:
+        json.dump({'version':c.BFS_TABLE_VERSION}, f)
     return df
 
 
+def _fetch_data(region_list, industry_list, series_to_adj, cache):
+    if cache:
+        return _cached_table() \
+            .pipe(_filter_parsed, region_list, industry_list, series_to_adj)
+
+    r = urllib2.urlopen(c.BFS_URL).read()
+    with ZipFile(BytesIO(r)).open("BFS-mf.csv") as bfs_file:
+        return _parse_bfs_file(
+            TextIOWrapper(bfs_file, encoding='utf-8'), region_list, 
+            industry_list, series_to_adj
+        )
+
+
 def _seasonal_adjust(df, seasonally_adj, series_lst, bf_helper_lst):
     if seasonally_adj and any([i.startswith('BF_DUR') for i in series_lst]):
         # Seasonal adjustment not available for DUR variables, so we just sub
@@ -82,13 +180,11 @@ def _seasonal_adjust(df, seasonally_adj, series_lst, bf_helper_lst):
         ]
         df_DUR = df[index_var + [s for s in series_lst if 'DUR' in s]] \
             .query('is_adj == False')
-        df_non_DUR = df \
-            [
-                index_var \
-                + [s for s in series_lst if 'DUR' not in s] \
-                + bf_helper_lst
-            ] \
-            .query('is_adj == True')
+        non_DUR_lst = [s for s in series_lst if 'DUR' not in s] + bf_helper_lst
+        if not non_DUR_lst:
+            # Only the unadjusted rows are read when every series is DUR
+            return df_DUR
+        df_non_DUR = df[index_var + non_DUR_lst].query('is_adj == True')
         return df_DUR.merge(
             df_non_DUR,
             on=['time', 'region', 'region_code', 'industry', 'naics']
@@ -97,61 +193,28 @@ def _seasonal_adjust(df, seasonally_adj, series_lst, bf_helper_lst):
         return df.query(f'is_adj == {seasonally_adj}')
 
 
-def _query_data(
-    df, region_lst, series_lst, bf_helper_lst, industry_lst, seasonally_adj
-):
+def _query_data(df, series_lst, bf_helper_lst, seasonally_adj):
     return df \
         .pipe(_seasonal_adjust, seasonally_adj, series_lst, bf_helper_lst) \
-        .query(f"region_code in {region_lst}") \
-        .query(f"naics in {industry_lst}") \
         [
             ['time', 'region', 'region_code', 'industry', 'naics'] \
             + series_lst + bf_helper_lst
         ]
 
 
-def _year_create_shift(x):
-    if x['time'].month <= 3:
-        return x['time'].year
-    return x['time'].year + 1
-
-
-def _time_annualize(df, march_shift):
-    if march_shift:
-        return df.assign(time=lambda x: x.apply(_year_create_shift, axis=1))
-    return df.assign(time=lambda x: x['time'].dt.year)
-
-
-def _DUR_numerator(df):
-    if 'BF_DUR4Q' in df.columns:
-        df = df.assign(DUR4_numerator=lambda x: x['BF_DUR4Q'] * x['BF_BF4Q'])
-    if 'BF_DUR8Q' in df.columns:
-        df = df.assign(DUR8_numerator=lambda x: x['BF_DUR8Q'] * x['BF_BF8Q'])
-    return df
-
-
-def _BF_DURQ(df):
-    if 'BF_DUR4Q' in df.columns:
-        df = df \
-            .assign(BF_DUR4Q=lambda x: x['DUR4_numerator'] / x['BF_BF4Q']) \
-            .drop('DUR4_numerator', 1)
-    if 'BF_DUR8Q' in df.columns:
-        df = df \
-            .assign(BF_DUR8Q=lambda x: x['DUR8_numerator'] / x['BF_BF8Q']) \
-            .drop('DUR8_numerator', 1)
-    return df
-
-
-def _annualize(df, annualize, bf_helper_lst, march_shift):
-    index_cols = ['fips', 'region', 'region_code', 'time', 'industry', 'naics']
+def _annualize(df, annualize, series_lst, bf_helper_lst, march_shift):
     if annualize:
-        return df \
-            .pipe(_time_annualize, march_shift) \
-            .pipe(_DUR_numerator) \
-            .groupby(index_cols) \
-            .sum(min_count=12) \
-            .pipe(_BF_DURQ) \
-            .reset_index(drop=False) \
+        # A march shift runs the year from April through March, labeled by
+        # the year it ends in. DUR variables are averaged, weighted by the
+        # corresponding business formations
+        return t.aggregate_periods(
+                df, ['fips', 'region', 'region_code', 'industry', 'naics'],
+                series_lst + bf_helper_lst, periods_per_year=12,
+                start=4 if march_shift else 1, label='end',
+                weights={
+                    s:s.replace('DUR', 'BF') for s in series_lst if 'DUR' in s
+                }
+            ) \
             .astype({'time':'int'}) \
             [[col for col in df.columns if col not in bf_helper_lst]]
     return df
@@ -159,7 +222,8 @@ def _annualize(df, annualize, bf_helper_lst, march_shift):
 
 def bfs(
     series_lst='all', obs_level='us', state_list='all', industry='00', 
-    seasonally_adj=True, annualize=False, march_shift=False
+    seasonally_adj=True, annualize=False, march_shift=False, compact=False,
+    cache=True, output='pandas', write_to=None
 ):
     """
     Fetch and clean Business Formation Statistics (BFS) data from the following
@@ -221,7 +285,32 @@ def bfs(
     march_shift: bool, default False
         Whether to use a "march shift" annualization method, wherein Q2 is 
         considered the start of the year.
+    compact: bool, default False
+        Whether to return the data in a compact schema: categorical
+        identifiers, integer time period codes, and Int32/float32 values. See
+        kauffman.tools.compact_dtypes.
+    cache: bool, default True
+        Whether to keep the BFS archive and its parsed table in the local cache
+        directory, under bfs/ in c.CACHE_DIR (~/.cache/kauffman, or the 
+        KAUFFMAN_CACHE_DIR environment variable). The archive is revalidated 
+        with the Census server on each call and only downloaded and parsed 
+        again when a new release is out. If the server cannot be reached, the
+        cached copy is used with a warning. Deleting the bfs/ directory clears
+        the cache. If False, nothing is written to disk: the archive is 
+        downloaded and only the requested slice is parsed.
+    output: {'pandas', 'arrow'}, default 'pandas'
+        The type of the returned data. 'arrow' returns a pyarrow.Table with a 
+        stable schema: dictionary-encoded identifiers, an int32 time period 
+        code, and float64 values. Requires pyarrow. See 
+        kauffman.tools.to_arrow. Not available with compact=True.
+    write_to: str, optional
+        A local path or S3 uri to also write the data to, as a Hive-partitioned
+        parquet dataset partitioned by dataset, obs_level, state and year. 
+        Only the partitions covered by this pull are overwritten. Requires 
+        pyarrow. See kauffman.tools.write_dataset.
     """
+    g._check_output(output, compact)
+
     series_lst = c.BFS_SERIES if series_lst == 'all' else series_lst
     
     state_list = c.STATES if state_list == 'all' else state_list    
@@ -243,18 +332,24 @@ def bfs(
         if ('BF_DUR8Q' in series_lst) and ('BF_BF8Q' not in series_lst): 
             bf_helper_lst.append('BF_BF8Q')
 
-    df, industry_key, series_key, region_key, time_key = _fetch_data()
+    # Seasonal adjustment is not available for the DUR variables, so those are
+    # always read unadjusted
+    series_to_adj = {
+        s:0 if 'DUR' in s else int(seasonally_adj)
+        for s in series_lst + bf_helper_lst
+    }
 
-    return df \
-        .pipe(clean_data, industry_key, series_key, region_key, time_key) \
-        .pipe(
-            _query_data, region_list, series_lst, bf_helper_lst, industry_list, 
-            seasonally_adj
-        ) \
-        .assign(
-            time=lambda x: pd.to_datetime(x['time'], format='%b-%Y'),
-            fips=lambda x: x.region_code.map(c.STATE_ABB_TO_FIPS)
-        ) \
-        .pipe(_annualize, annualize, bf_helper_lst, march_shift) \
+    df = _fetch_data(region_list, industry_list, series_to_adj, cache) \
+        .pipe(_query_data, series_lst, bf_helper_lst, seasonally_adj) \
+        .assign(fips=lambda x: x.region_code.map(c.STATE_ABB_TO_FIPS)) \
+        .pipe(_annualize, annualize, series_lst, bf_helper_lst, march_shift) \
         [['fips', 'region', 'naics', 'industry', 'time'] + series_lst] \
-        .reset_index(drop=True)
\ No newline at end of file
+        .reset_index(drop=True)
+
+    if write_to:
+        g.write_dataset(df, write_to, 'bfs', obs_level, series_lst)
+    if output == 'arrow':
+        return g.to_arrow(df, series_lst)
+    if compact:
+        return g.compact_dtypes(df, series_lst)
+    return df
@@ -1,10 +1,11 @@
 import os
-import requests
-import numpy as np
+import re
 import pandas as pd
+from io import BytesIO
 from kauffman import constants as c
 from kauffman.tools import api_tools as api
 from kauffman.tools import general_tools as g
+from kauffman.tools import vintage_tools as v
 
 # https://www.census.gov/programs-surveys/popest.html
 
@@ -29,10 +30,10 @@ def _fips_region_time(df, geo_level, date_var, date_code_shift, region_var):
 
 def _fetch_from_api(
     url, geo_level, date_var, date_code_shift, start_year, end_year, region_var,
-    pop_var, key
+    pop_var, key, s
 ):
     url = url + f'&key={key}' if key else url
-    return api.fetch_from_url(url, requests) \
+    return api.fetch_from_url(url, s) \
         .rename(columns={pop_var:'population'}) \
         .pipe(
             _fips_region_time, geo_level, date_var, date_code_shift, region_var
@@ -42,30 +43,31 @@ def _fetch_from_api(
         .query(f'{start_year} <= time <= {end_year}') \
 
 
-def _2000_2009(geo_level, key):
+def _2000_2009(geo_level, key, s):
     geos = '1' if geo_level == 'us' else '*'
     url = f'https://api.census.gov/data/2000/pep/int_population?get=GEONAME,POP,DATE_&for={geo_level}:{geos}'
     return _fetch_from_api(
-        url, geo_level, 'DATE_', -2, 2000, 2009, 'GEONAME', 'POP', key
+        url, geo_level, 'DATE_', -2, 2000, 2009, 'GEONAME', 'POP', key, s
     )
 
 
-def _2010_2019(geo_level, key):
+def _2010_2019(geo_level, key, s):
     url = f'https://api.census.gov/data/2019/pep/population?get=NAME,POP,DATE_CODE&for={geo_level}:*'
     return _fetch_from_api(
-        url, geo_level, 'DATE_CODE', 7, 2010, 2019, 'NAME', 'POP', key
+        url, geo_level, 'DATE_CODE', 7, 2010, 2019, 'NAME', 'POP', key, s
     )
 
 
-def _2020(geo_level):
+def _2020(geo_level, s):
     url = 'https://www2.census.gov/programs-surveys/popest/datasets/2010-2020/' \
         + {'county':'counties', 'state':'state', 'us':'national'}[geo_level] \
         + '/totals/' \
         + ('co-est2020.csv' if geo_level == 'county' else 'nst-est2020.csv')
+    content = BytesIO(api._get(url, s).content)
 
     if geo_level == 'county':
         df = pd.read_csv(
-            url,
+            content,
             encoding='cp1252',
             dtype={'STATE':str, 'COUNTY':str}
         ) \
@@ -73,7 +75,7 @@ def _2020(geo_level):
         .assign(fips=lambda x: x['STATE'] + x['COUNTY']) \
         .rename(columns={'CTYNAME': 'region'})
     else:
-        df = pd.read_csv(url, dtype={'STATE':str}) \
+        df = pd.read_csv(content, dtype={'STATE':str}) \
             .rename(columns={'STATE': 'fips', 'NAME':'region'})
         if geo_level == 'state':
             df = df.query('fips not in ["00", "72"]')
@@ -86,185 +88,149 @@ def _2020(geo_level):
         [['fips', 'region', 'time', 'population']]
 
 
-def _2021(geo_level, key):
+def _2021(geo_level, key, s):
     url = f'https://api.census.gov/data/2021/pep/population?get=NAME,POP_2021&for={geo_level}:*'
     return _fetch_from_api(
-        url, geo_level, None, None, 2021, 2021, 'NAME', 'POP_2021', key
+        url, geo_level, None, None, 2021, 2021, 'NAME', 'POP_2021', key, s
     )
 
 
-def _format_txt_row(row, i_start, i_end):
-    return row[:i_start] + [' '.join(row[i_start: i_end])] + row[i_end:]
+def _txt_field_pattern(field, fips):
+    if field is None:
+        return r'\S+'
+    elif field == 'fips':
+        return f'(?P<fips>{fips})'
+    elif field == 'state':
+        return r'(?P<state>\S+)'
+    elif field == 'region':
+        return r'(?P<region>\S.*?)'
+    return rf'(?P<population{field}>[\d,]+)'
 
 
-def _filter_county_txt(df):
-    return df \
-        .query('fips != "FIPS"') \
-        .query('fips != "Code"') \
-        .reset_index(drop=True)
+def _txt_pattern(fields, fips=r'\d+'):
+    # Fields are separated by any whitespace, including line breaks, so that
+    # records wrapped onto a second line are matched whole
+    return r'^\s*' \
+        + r'\s+'.join([_txt_field_pattern(field, fips) for field in fields]) \
+        + r'\s*$'
 
 
-def _county_1980_1989():
-    list_1980, list_1985 = [], []
-    current_data_year = 1980
+def _line_index(lines, bound, start=0):
+    if type(bound) == str:
+        return next(
+            i for i in range(start, len(lines)) if re.match(bound, lines[i])
+        )
+    return bound
 
-    url = 'https://www2.census.gov/programs-surveys/popest/tables/1980-1990/counties/totals/e8089co.txt'
-    lines_iter = iter(requests.get(url).text.split('\n')[25:])
-    while True:
-        row = lines_iter.__next__().split()
 
-        if not row:
-            continue
-        if row and row[0] == 'FIPS':
-            current_data_year = 1985 if current_data_year == 1980 else 1980
-        if len(row) < 7:
-            row = row + lines_iter.__next__().split()
+def _read_txt_section(lines, section):
+    start = _line_index(lines, section['lines'][0])
+    end = _line_index(lines, section['lines'][1], start + 1)
+    text = pd.Series(['\n'.join(lines[start:end])])
 
-        if current_data_year == 1980:
-            list_1980.append(_format_txt_row(row, 1, -5))
-        else:
-            list_1985.append(_format_txt_row(row, 1, -5))
-            if row[0] == '56045':
-                break
+    overrides = section.get('overrides', {})
+    default_fips = ''.join(f'(?!{fips})' for fips in overrides) + r'\d+'
+    return pd.concat(
+        [
+            text.str.extractall(
+                _txt_pattern(section['fields'], default_fips), flags=re.M
+            )
+        ]
+        + [
+            text.str.extractall(_txt_pattern(fields, fips), flags=re.M)
+            for fips, fields in overrides.items()
+        ]
+    )
 
-    df_1980 = pd.DataFrame(
-            list_1980, 
-            columns=['fips', 'region'] + _pop_cols(1980, 1984)
-        ) \
-        .pipe(_filter_county_txt)
-    df_1985 = pd.DataFrame(
-            list_1985, 
-            columns=['fips', 'region'] + _pop_cols(1985, 1989)
-        ) \
-        .pipe(_filter_county_txt) \
-        .drop(columns='region')
 
-    return df_1980 \
-        .merge(df_1985, how='left', on='fips') \
-        .pipe(pd.wide_to_long, 'population', i='fips', j='time') \
-        .query(f'region not in {list(c.STATE_NAME_TO_ABB.keys())}') \
-        .assign(
-            region=lambda x: x['region'].replace(r'Co\.', 'County', regex=True)
-        ) \
-        .reset_index(drop=False)
-
-
-def _county_1990_1999():
-    data_list = []
-    url = 'https://www2.census.gov/programs-surveys/popest/tables/1990-2000/counties/totals/99c8_00.txt'
-    lines = requests.get(url).text.split('\n')[12:3203]
-    for line in lines:
-        row = line.split()
-        if row[1] == '49041':
-            data_list.append(
-                row[1:7] + [np.nan] + row[10:14] + [' '.join(row[15:])]
+def _block_sections(lines, layout):
+    start, stop = layout['blocks']['lines']
+    n_sections = len(layout['sections'])
+    sections, i, block_start = [], 0, start
+    for j in range(start, len(lines)):
+        if re.match(layout['blocks']['header'], lines[j]):
+            sections.append(
+                {**layout['sections'][i], 'lines': (block_start, j)}
             )
-        elif row[1] == '50027':
-            data_list.append(
-                row[1:7] + [np.nan] + row[9:13] + [' '.join(row[14:])]
+            i, block_start = (i + 1) % n_sections, j
+        elif i == n_sections - 1 and re.match(stop, lines[j]):
+            # The stop record is kept, with its second line if it is wrapped
+            fields = layout['sections'][i]['fields']
+            end = j + 1 + (len(lines[j].split()) < len(fields))
+            sections.append(
+                {**layout['sections'][i], 'lines': (block_start, end)}
             )
-        else:
-            data_list.append(row[1:12] + [' '.join(row[13:])])
-
-    return pd.DataFrame(
-            data_list, 
-            columns=['fips'] \
-                + [f'population{str(year)}' for year in range(1999, 1989, -1)] \
-                + ['region']
-        ) \
-        .pipe(pd.wide_to_long, 'population', i='fips', j='time') \
-        .query(f'region not in {list(c.STATE_NAME_TO_ABB.keys())}') \
-        .reset_index() \
+            return sections
+    sections.append(
+        {**layout['sections'][i], 'lines': (block_start, len(lines))}
+    )
+    return sections
+
+
+def _read_txt(text, layout):
+    lines = text.split('\n')
+    sections = _block_sections(lines, layout) if 'blocks' in layout \
+        else layout['sections']
+    df = pd.concat([
+            _read_txt_section(lines, section)
+            .melt(
+                id_vars=[
+                    f for f in section['fields'] if type(f) == str
+                ],
+                var_name='time', value_name='population'
+            )
+            for section in sections
+        ]) \
         .assign(
-            population=lambda x: x['population'].replace(',', '', regex=True)
-        )
-        
+            time=lambda x: x['time'].str[len('population'):].astype('int'),
+            population=lambda x: pd.to_numeric(
+                x['population'].str.replace(',', '', regex=False)
+            ) * layout['scale']
+        ) \
+        .query(f'{layout["years"][0]} <= time <= {layout["years"][1]}')
 
-def _format_state_txt(df, decade, format_pop=True):
-    return df \
-        .query(f'time < {decade + 10}') \
-        .reset_index() \
-        .assign(
-            population=lambda x: x['population'] \
-                .replace(',', '', regex=True).astype('int') \
-                * 1000 if format_pop else x['population'],
-            region=lambda x: x['region'].map(c.STATE_ABB_TO_NAME),
+    if 'state' in df.columns:
+        df = df.assign(
+            region=lambda x: x['state'].map(c.STATE_ABB_TO_NAME),
             fips=lambda x: x['region'].map(c.ALL_NAME_TO_FIPS)
-        ) \
+        )
+    return df \
+        .reset_index(drop=True) \
         [['fips', 'region', 'time', 'population']]
 
 
-def _fetch_state_txt(url, lrange, cols):
-    lines = requests.get(url).text.split('\n')
-    return pd.DataFrame(
-            [line.split() for line in lines[lrange[0]: lrange[1]]], 
-            columns=cols
-        ) \
-        .pipe(pd.wide_to_long, 'population', i='region', j='time')
-
-
-def _pop_cols(start, end):
-    return list(map(lambda x: f'population{x}', range(start, end + 1)))
-
-
-def _state_1900_1989(decade):
-    url_code = {
-        **{int(f'19{i}0'):f'st{i}0{i}9ts' for i in range(0,6)},
-        **{int(f'19{i}0'):f'st{i}0{i + 1}0ts' for i in range(5,9)}
-    }[decade]
-    url = f'https://www2.census.gov/programs-surveys/popest/tables/1980-1990/state/asrh/{url_code}.txt'
-    line_ranges = {
-        **{decade: [(23,72), (82,-1)] for decade in range(1900, 1940, 10)},
-        **{
-            1940: [(21, 70), (79,-1)],
-            1950: [(27, 78), (92, -3)],
-            1960: [(24, 75), (86,-1)], 
-            1970: [(14, 65), (67, -8)],
-            1980: [(11, 62), (70, -1)]
-        }
-    }[decade]
-    line_range1, line_range2 = line_ranges[0], line_ranges[1]
-    
-    if decade in [1900, 1910, 1920, 1930, 1940]:
-        cols1 = ['region'] + _pop_cols(decade, decade + 5)
-        cols2 = ['region'] + _pop_cols(decade + 6, decade + 9) 
-        format_pop = True
-    elif decade in [1950, 1960]:
-        cols1 = ['region', 'census'] + _pop_cols(decade, decade + 4)
-        cols2 = ['region'] + _pop_cols(decade + 5, decade + 10)
-        format_pop = True
-    elif decade == 1970:
-        cols1 = ['id', 'region'] + _pop_cols(decade, decade + 5)
-        cols2 = ['id', 'region'] + _pop_cols(decade + 6, decade + 10)
-        format_pop = False
-    elif decade == 1980:
-        cols1 = ['region'] + _pop_cols(decade, decade + 4)
-        cols2 = ['region'] + _pop_cols(decade + 5, decade + 10)
-        format_pop = False
-    
-    return _fetch_state_txt(url, line_range1, cols1) \
-        .append(_fetch_state_txt(url, line_range2, cols2)) \
-        .pipe(_format_state_txt, decade, format_pop=format_pop)
-
-
-def _state_1990_1999():
-    url = 'https://www2.census.gov/programs-surveys/popest/tables/1990-2000/state/totals/st-99-07.txt'
-    lines = requests.get(url).text.split('\n')[28: 79]
-    return pd.DataFrame(
-            [_format_txt_row(line.split(), 2, -11) for line in lines],
-            columns=['block', 'fips', 'region'] \
-                + list(map(lambda x: f'population{x}', range(1999, 1989, -1))) \
-                + ['census']
+def _fetch_txt(layout, s):
+    return _read_txt(api._get(layout['url'], s).text, layout)
+
+
+def _county_1980_1989(s):
+    # Only the counties in the 1980-84 tables are kept, as in their 1985-89 
+    # counterparts, and their names are spelled out
+    df = _fetch_txt(c.PEP_COUNTY_1980_LAYOUT, s)
+    return df[df['fips'].isin(df.query('time == 1980')['fips'])] \
+        .query(f'region not in {list(c.STATE_NAME_TO_ABB.keys())}') \
+        .assign(
+            region=lambda x: x['region'].replace(r'Co\.', 'County', regex=True)
         ) \
-        .drop(['block', 'census'], 1) \
-        .pipe(pd.wide_to_long, 'population', i='region', j='time') \
-        .reset_index() \
-        [['fips', 'region', 'time', 'population']]
+        .reset_index(drop=True)
+
+
+def _county_1990_1999(s):
+    return _fetch_txt(c.PEP_COUNTY_1990_LAYOUT, s) \
+        .query(f'region not in {list(c.STATE_NAME_TO_ABB.keys())}')
 
 
-def _us_1900_1999():
+def _state_1900_1989(decade, s):
+    return _fetch_txt(c.PEP_STATE_DECADE_LAYOUTS[decade], s)
+
+
+def _state_1990_1999(s):
+    return _fetch_txt(c.PEP_STATE_1990_LAYOUT, s)
+
+
+def _us_1900_1999(s):
     url = 'https://www2.census.gov/programs-surveys/popest/tables/1900-1980/national/totals/popclockest.txt'
-    lines = requests.get(url).text.split('\n')
+    lines = api._get(url, s).text.split('\n')
     return pd.DataFrame(
             [line.split()[2:4] for line in lines[10:-25]], 
             columns=['time', 'population']
@@ -277,7 +243,38 @@ def _us_1900_1999():
             .dropna()
 
 
-def pep(obs_level='us', state_list='all', key=os.getenv("CENSUS_KEY")):
+def _fetch_vintage(source, store, s):
+    fetch_fn, args = source
+    if store and fetch_fn != _2021:
+        # Every vintage but the latest is final, so it is read from the 
+        # vintage store, keyed by the source and geography (not the api key)
+        name = 'pep/' + '_'.join(
+            [fetch_fn.__name__.strip('_')] + [str(arg) for arg in args[:1]]
+        )
+        return v.load_vintage(
+            name, fetch_fn, args + [s], version=c.PEP_VINTAGE_VERSION
+        )
+    return fetch_fn(*args, s)
+
+
+def _sources(obs_level, key):
+    if obs_level in ['county', 'msa']:
+        return [(_county_1980_1989, []), (_county_1990_1999, [])] \
+            + [(f, ['county', key]) for f in [_2000_2009, _2010_2019]] \
+            + [(_2020, ['county'])]
+    elif obs_level == 'state':
+        return [(_state_1900_1989, [year]) for year in range(1900,1981,10)] \
+            + [(_state_1990_1999, []), (_2020, ['state'])] \
+            + [(f, ['state', key]) for f in [_2000_2009, _2010_2019, _2021]]
+    else:
+        return [(_us_1900_1999, []), (_2020, ['us'])] \
+            + [(f, ['us', key]) for f in [_2000_2009, _2010_2019, _2021]]
+
+
+def pep(
+    obs_level='us', state_list='all', key=os.getenv("CENSUS_KEY"), 
+    compact=False, n_threads=None, store=True, output='pandas', write_to=None
+):
     """
     Fetches and cleans Population Estimates Program (PEP) data from one of two 
     sources, depending on the year and obs_level: 
@@ -296,7 +293,32 @@ def pep(obs_level='us', state_list='all', key=os.getenv("CENSUS_KEY")):
         Census API key. See README for instructions on how to get one, if 
         desired. Otherwise, user can pass key=None, which will work until the
         Census's data limit is exceeded.
+    compact: bool, default False
+        Whether to return the data in a compact schema: categorical
+        identifiers, integer time period codes, and Int32/float32 values. See
+        kauffman.tools.compact_dtypes.
+    n_threads: int, optional
+        Number of threads to use when fetching the data. Each vintage source 
+        (decade text file, csv, or API call) is downloaded and parsed in its 
+        own task over a shared session. Defaults to one thread per source, so 
+        that the fetch takes as long as the slowest source.
+    store: bool, default True
+        Whether to read the historical vintages (everything before the latest
+        year) from the local vintage store, building it on first use. See 
+        kauffman.tools.load_vintage. If False, every vintage is fetched.
+    output: {'pandas', 'arrow'}, default 'pandas'
+        The type of the returned data. 'arrow' returns a pyarrow.Table with a 
+        stable schema: dictionary-encoded identifiers, an int32 time period 
+        code, and float64 values. Requires pyarrow. See 
+        kauffman.tools.to_arrow. Not available with compact=True.
+    write_to: str, optional
+        A local path or S3 uri to also write the data to, as a Hive-partitioned
+        parquet dataset partitioned by dataset, obs_level, state and year. 
+        Only the partitions covered by this pull are overwritten. Requires 
+        pyarrow. See kauffman.tools.write_dataset.
     """
+    g._check_output(output, compact)
+
     # Warn users if they didn't provide a key
     if key == None:
         print('WARNING: You did not provide a key. Too many requests will ' \
@@ -307,12 +329,12 @@ def pep(obs_level='us', state_list='all', key=os.getenv("CENSUS_KEY")):
     state_list = [c.STATE_ABB_TO_FIPS[s] for s in state_list]
 
     # Fetch data
+    sources = _sources(obs_level, key)
+    n_threads = len(sources) if n_threads is None else n_threads
+    df = api.run_in_parallel(_fetch_vintage, sources, [store], n_threads)
+
     if obs_level in ['county', 'msa']:
-        df = pd.concat(
-                [_county_1980_1989(), _county_1990_1999()]
-                + [f('county', key) for f in [_2000_2009, _2010_2019]]
-                + [_2020('county')]
-            ) \
+        df = df \
             .assign(
                 region=lambda x: x['fips'].map(c.ALL_FIPS_TO_NAME),
                 fips_state=lambda x: x.fips.str[0:2]
@@ -323,25 +345,23 @@ def pep(obs_level='us', state_list='all', key=os.getenv("CENSUS_KEY")):
                 .pipe(g.aggregate_county_to_msa, 'fips', ['population']) \
                 [['fips', 'region', 'time', 'population']]
     elif obs_level == 'state':
-        df = pd.concat(
-                [_state_1900_1989(year) for year in range(1900,1981,10)]
-                + [_state_1990_1999(), _2020('state')]
-                + [f('state', key) for f in [_2000_2009, _2010_2019, _2021]]
-            ) \
-            .query(f'fips in {state_list}')
-    else:
-        df = pd.concat(
-            [_us_1900_1999(), _2020('us')]
-            + [f('us', key) for f in [_2000_2009, _2010_2019, _2021]]
-        )
+        df = df.query(f'fips in {state_list}')
 
     # TODO: Keep this? Would need to update kese, neb, and eji
     # columns = ['fips', 'region', 'time', 'population']
     # if obs_level in ['county', 'msa']:
     #     columns = ['fips', 'fips_state', 'region', 'time', 'population']
 
-    return df \
+    df = df \
         .astype({'population': 'float', 'time': 'int'}) \
         .sort_values(['fips', 'time']) \
         .reset_index(drop=True) \
-        [['fips', 'region', 'time', 'population']]
\ No newline at end of file
+        [['fips', 'region', 'time', 'population']]
+
+    if write_to:
+        g.write_dataset(df, write_to, 'pep', obs_level, ['population'])
+    if output == 'arrow':
+        return g.to_arrow(df, ['population'])
+    if compact:
+        return g.compact_dtypes(df, ['population'])
+    return df
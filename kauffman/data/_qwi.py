@@ -8,6 +8,7 @@ from kauffman import constants as c
 from kauffman.tools import qwi_tools as q
 from kauffman.tools import general_tools as g
 from kauffman.tools import api_tools as api
+from kauffman.tools import time_tools as t
 from webdriver_manager.chrome import ChromeDriverManager
 
 from selenium import webdriver
@@ -19,7 +20,9 @@ from selenium.webdriver.support import expected_conditions as EC
 
 def _year_groups(state_dict, max_years_per_call):
     years = list(range(state_dict['start_year'], state_dict['end_year'] + 1))
-    if max_years_per_call == 1:
+    if not years:
+        return []
+    elif max_years_per_call == 1:
         return years
     else:
         n_bins = ceil(len(years) / max_years_per_call)
@@ -28,10 +31,9 @@ def _year_groups(state_dict, max_years_per_call):
 
 def _url_groups(
     obs_level, looped_strata, max_years_per_call, private, state_list, 
-    fips_list, annualize
+    fips_list, state_to_years
 ):
     out_lst = []
-    state_to_years = q._get_state_to_years(annualize)
 
     var_to_levels = {
         **c.QWI_STRATA_TO_LEVELS,
@@ -299,40 +301,124 @@ def _qwi_fetch_api_data(
     return api.fetch_from_url(url, s)
 
 
+def _bulk_urls(
+    state_fips, obs_level, private, firm_char, worker_char, strata_totals
+):
+    state = c.STATE_FIPS_TO_ABB[state_fips].lower()
+    database = _database_name(worker_char)
+    firm_type = 'fa' if 'firmage' in firm_char \
+        else 'fs' if 'firmsize' in firm_char \
+        else 'f'
+    geo_cat = c.QWI_GEO_TO_BULK_GEOCAT[obs_level]
+    ownercode = 'op' if private else 'oslp'
+
+    # The sector file does not contain the all-industry total, so we also need
+    # the aggregate file when the industry totals are requested
+    if 'industry' not in firm_char:
+        ind_levels = ['n']
+    elif strata_totals:
+        ind_levels = ['n', 'ns']
+    else:
+        ind_levels = ['ns']
+
+    return [
+        f'{c.QWI_BULK_URL}/{state}/qwi_{state}_{database}_{firm_type}_' \
+            f'{geo_cat}_{ind_level}_{ownercode}_u.csv.gz'
+        for ind_level in ind_levels
+    ]
+
+
+def _bulk_strata_levels(strata, private):
+    strata_to_levels = {}
+    for s, levels in c.QWI_STRATA_TO_LEVELS.items():
+        levels = [str(l) for l in levels]
+        if s == 'industry' and private:
+            levels = [l for l in levels if l != '92']
+        strata_to_levels[s] = levels if s in strata else levels[:1]
+    return strata_to_levels
+
+
+def _filter_bulk_chunk(df, obs_level, strata_to_levels, fips_list, years):
+    year = df['year'].astype(int)
+    mask = (year >= years['start_year']) & (year <= years['end_year'])
+    for s, levels in strata_to_levels.items():
+        mask &= df[s].isin(levels)
+    if fips_list:
+        geography = df['geography'].str[-5:] if obs_level == 'msa' \
+            else df['geography']
+        mask &= geography.isin(fips_list)
+    return df[mask]
+
+
+def _bulk_to_api_format(df, obs_level, strata):
+    unused_strata = [s for s in c.QWI_STRATA_TO_LEVELS if s not in strata]
+    df = df \
+        .drop(columns=unused_strata) \
+        .rename(columns=c.QWI_BULK_TO_API_COLS) \
+        .assign(
+            time=lambda x: x['year'] + '-Q' + x['quarter'],
+            state=lambda x: x['geography'].str[:2]
+        )
+    if obs_level == 'county':
+        df['county'] = df['geography'].str[2:]
+    elif obs_level == 'msa':
+        df[c.API_MSA_STRING] = df['geography'].str[-5:]
+    return df.drop(columns=['geography', 'year', 'quarter'])
+
+
+def _qwi_fetch_bulk_data(
+    state_fips, indicator_list, obs_level, fips_list, private, firm_char,
+    worker_char, strata_totals, state_to_years, s
+):
+    strata_to_levels = _bulk_strata_levels(firm_char + worker_char, private)
+    bulk_indicators = {
+        v:k for k,v in c.QWI_BULK_TO_API_COLS.items()
+    }
+    usecols = ['geo_level', 'geography', 'industry', 'ownercode', 'year',
+        'quarter'] \
+        + list(strata_to_levels) \
+        + [bulk_indicators.get(x, x) for x in indicator_list]
+
+    df_lst = []
+    for url in _bulk_urls(
+        state_fips, obs_level, private, firm_char, worker_char, strata_totals
+    ):
+        r = s.get(url, stream=True)
+        if r.status_code != 200:
+            raise Exception(
+                f'Failed to fetch bulk file {url}. Status code: {r.status_code}'
+            )
+        reader = pd.read_csv(
+            r.raw, compression='gzip', dtype='str',
+            usecols=lambda x: x in usecols, chunksize=c.QWI_BULK_CHUNKSIZE
+        )
+        df_lst += [
+            _filter_bulk_chunk(
+                chunk, obs_level, strata_to_levels, fips_list,
+                state_to_years[state_fips]
+            )
+            for chunk in reader
+        ]
+        r.close()
+
+    return pd.concat(df_lst) \
+        .pipe(_bulk_to_api_format, obs_level, firm_char + worker_char)
+
+
 def _cols_to_numeric(df, var_lst):
     df[var_lst] = df[var_lst].apply(pd.to_numeric, downcast='integer')
     return df
 
 
-def _annualize_data(df, annualize, covars):
+def _annualize_data(df, annualize, covars, indicator_list):
     if not annualize:
         return df
-    elif annualize == 'April':
-        df = df \
-            .assign(
-                quarter=lambda x: x['time'].str[-1:],
-                time=lambda x: x.apply(
-                    lambda y: int(y['time'][:4]) - 1 \
-                        if y['quarter'] == '1' else int(y['time'][:4]),
-                    axis=1
-                )
-            ) \
-            .drop('quarter', 1)
-    else:
-        df = df \
-            .assign(
-                time=lambda x: x['time'].str[:4].astype(int),
-            )
-    return df \
-        .assign(
-            row_count=lambda x: x['fips'] \
-                .groupby([x[var] for var in covars], dropna=False) \
-                .transform('count')
+
+    return t.aggregate_periods(
+            df, [col for col in covars if col != 'time'], indicator_list,
+            start=2 if annualize == 'April' else 1, drop_incomplete=True
         ) \
-        .query('row_count == 4') \
-        .drop(columns=['row_count']) \
-        .groupby(covars).sum(min_count=4) \
-        .reset_index(drop=False)
+        [covars + indicator_list]
 
 
 def _filter_strata_totals(df, firm_char, worker_char, strata_totals):
@@ -351,46 +437,162 @@ def _filter_strata_totals(df, firm_char, worker_char, strata_totals):
     return df
 
 
-def _aggregate_msas(df, covars, obs_level):
+def _aggregate_msas(df, covars, indicator_list, obs_level):
     if obs_level != 'msa':
         return df
-    return df \
-        .assign(
-            msa_states=lambda x: x[['state', 'fips']].groupby('fips') \
-                .transform('nunique'),
-            msa_row_count=lambda x: x[covars + ['msa_states']].groupby(covars) \
-                .transform('count')
-        ) \
-        .query('msa_row_count == msa_states') \
-        .drop(columns=['msa_states', 'msa_row_count']) \
+
+    # An MSA-period is complete when a row came in from each of the MSA's
+    # states, so the row count is summed alongside the indicators and compared
+    # against the crosswalk's state count. MSAs missing from the crosswalk 
+    # fall back to the number of states observed in the data.
+    observed_n_states = df.groupby('fips')['state'].nunique()
+    unmatched = set(df['fips']) - set(c.MSA_TO_N_STATES)
+    if unmatched:
+        print(
+            'Warning: The following MSAs are not in the crosswalk, and are',
+            'complete when they have data from all of their observed states:',
+            sorted(unmatched)
+        )
+    df = df[covars + indicator_list] \
+        .assign(_n_states=1) \
         .groupby(covars).sum() \
         .reset_index(drop=False)
+    n_states = df['fips'].map(c.MSA_TO_N_STATES) \
+        .fillna(df['fips'].map(observed_n_states))
+    complete = df['_n_states'] == n_states
 
-
-def _state_overlap(x, state_list_orig):
-    if list(set(x.split(', ')[1].split('-')) & set(state_list_orig)):
-        return 1
-    else:
-        return 0
+    dropped = set(df['fips']) - set(df.loc[complete, 'fips'])
+    if dropped:
+        print(
+            'Warning: The following MSAs were dropped, since no period had',
+            'data from all of their states:', sorted(dropped)
+        )
+    return df[complete].drop(columns='_n_states')
 
 
 def _remove_extra_msas(df, state_list, state_list_orig):
     if sorted(state_list) == sorted(state_list_orig):
         return df
     else:
-        return df \
-            .assign(_keep=lambda x: x['region'] \
-                .apply(lambda y: _state_overlap(
-                    y, [c.STATE_FIPS_TO_ABB[fips] for fips in state_list_orig]
-                ))) \
-            .query('_keep == 1') \
-            .drop(columns='_keep')
+        # MSAs missing from the crosswalk are kept when one of the states they
+        # were observed in was requested
+        msas = [
+            msa for msa, states in c.MSA_TO_STATE_FIPS.items()
+            if set(states) & set(state_list_orig)
+        ] + df.loc[
+                ~df['fips'].isin(list(c.MSA_TO_STATE_FIPS)) 
+                & df['state'].isin(state_list_orig),
+                'fips'
+            ] \
+            .unique() \
+            .tolist()
+        return df[df['fips'].isin(msas)]
+
+
+def _clean_data(
+    df, indicator_list, obs_level, firm_char, worker_char, strata_totals, 
+    annualize, covars, state_list, state_list_orig
+):
+    return df \
+        .drop_duplicates() \
+        .pipe(api._create_fips, obs_level) \
+        .pipe(_cols_to_numeric, indicator_list) \
+        .pipe(_filter_strata_totals, firm_char, worker_char, strata_totals) \
+        .pipe(_remove_extra_msas, state_list, state_list_orig) \
+        .pipe(_aggregate_msas, covars, indicator_list, obs_level) \
+        [covars + indicator_list] \
+        .pipe(_annualize_data, annualize, covars, indicator_list)
+
+
+def _years_since_prior(
+    state_to_years, prior_end_quarter, annualize, obs_level, state_list
+):
+    years_since = q._state_to_years_since(
+        state_to_years, prior_end_quarter, annualize
+    )
+    if obs_level != 'msa':
+        return years_since
+
+    # MSAs that cross state lines need every component state for a given year,
+    # so all states are refreshed from the earliest affected year
+    start_year = min(years_since[s]['start_year'] for s in state_list)
+    return {
+        state: {
+            'start_year': max(start_year, years['start_year']),
+            'end_year': years['end_year']
+        }
+        for state, years in state_to_years.items()
+    }
+
+
+def _plain_prior_data(prior_df, indicator_list, annualize):
+    # A compact or arrow prior_df is converted back to the plain schema, so 
+    # that its time and fips values match the ones of the new pull
+    if prior_df is None:
+        return prior_df
+    if not isinstance(prior_df, pd.DataFrame):
+        prior_df = prior_df.to_pandas()
+    time = prior_df['time']
+    if pd.api.types.is_numeric_dtype(time):
+        time = time.astype('int64')
+        if not annualize:
+            time = (time // 10).astype(str) + '-Q' + (time % 10).astype(str)
+    return prior_df \
+        .assign(time=time) \
+        .apply(
+            lambda x: x.astype('float64') if x.name in indicator_list \
+                else x.astype(object) \
+                    if isinstance(x.dtype, pd.CategoricalDtype) \
+                else x
+        )
+
+
+def _merge_prior_data(
+    df, prior_df, covars, state_to_years, obs_level, state_list
+):
+    if prior_df is None:
+        return df
+
+    # The refreshed years are dropped from prior_df outright, so that cells 
+    # missing from the new pull (e.g. newly suppressed) are not kept stale
+    year = prior_df['time'].astype(str).str[:4].astype(int)
+    if obs_level == 'msa':
+        start_year = min(state_to_years[s]['start_year'] for s in state_list)
+        refreshed = year >= start_year
+    else:
+        years = pd.DataFrame.from_dict(state_to_years, orient='index') \
+            .loc[state_list]
+        state = prior_df['fips'].str[:2]
+        refreshed = (year >= state.map(years['start_year'])) \
+            & (year <= state.map(years['end_year']))
+    return pd.concat([prior_df[~refreshed], df]) \
+        .drop_duplicates(covars, keep='last')
 
 
 def _qwi_fetch_data(
-    indicator_list, obs_level, state_list, fips_list, private, annualize, 
-    firm_char, worker_char, key, n_threads
+    indicator_list, obs_level, state_list, fips_list, private, state_to_years,
+    firm_char, worker_char, strata_totals, source, key, n_threads
 ):
+    if source == 'bulk':
+        if fips_list and obs_level == 'msa':
+            state_list = g.geolevel_crosswalk('msa', 'state', fips_list) \
+                ['fips_state'].unique().tolist()
+        elif fips_list:
+            state_list = list(dict.fromkeys(x[:2] for x in fips_list))
+        return api.run_in_parallel(
+            data_fetch_fn = _qwi_fetch_bulk_data,
+            groups = [
+                state for state in state_list
+                if state_to_years[state]['start_year'] \
+                    <= state_to_years[state]['end_year']
+            ],
+            constant_inputs = [
+                indicator_list, obs_level, fips_list, private, firm_char,
+                worker_char, strata_totals, state_to_years
+            ],
+            n_threads=n_threads
+        )
+
     if obs_level == 'us':
         return _scrape_led_data(private, firm_char, worker_char) \
             .assign(
@@ -415,7 +617,7 @@ def _qwi_fetch_data(
             ]
     groups = _url_groups(
         obs_level, looped_strata, max_years_per_call, private, state_list, 
-        fips_list, annualize
+        fips_list, state_to_years
     )
 
     return api.run_in_parallel(
@@ -431,8 +633,10 @@ def _qwi_fetch_data(
 def qwi(
     indicator_list='all', obs_level='us', state_list='all', fips_list=[],
     private=False, annualize='January', firm_char=[], worker_char=[], 
-    strata_totals=False, enforce_release_consistency=False, 
-    key=os.getenv("CENSUS_KEY"), n_threads=1
+    strata_totals=False, enforce_release_consistency=False, source='api',
+    prior_df=None, prior_end_quarter=None, max_cells=100000000,
+    key=os.getenv("CENSUS_KEY"), n_threads=1, compact=False,
+    output='pandas', write_to=None
 ):
     """
     Fetches and cleans Quarterly Workforce Indicators (QWI) data either from one
@@ -522,6 +726,33 @@ def qwi(
     enforce_release_consistency: bool, default False
         Whether to raise an error if the data for the selected states come from
         different releases.
+    source: {'api', 'bulk'}, default 'api'
+        Where to fetch state, MSA, or county data from. If 'api', the data is
+        pulled from the Census's API. If 'bulk', the per-state compressed files
+        published at https://lehd.ces.census.gov/data/qwi/latest_release are
+        streamed instead, with states downloaded in parallel according to
+        n_threads. 'bulk' is much faster for large pulls, and does not require
+        a key. Not available for obs_level = 'us'.
+    prior_df: DataFrame or pyarrow.Table, optional
+        A previously fetched result of this function, called with the same
+        arguments. If provided along with prior_end_quarter, only the years
+        affected by quarters released after prior_end_quarter are fetched, and
+        those years are replaced in (or appended to) prior_df. A compact or 
+        arrow prior_df is converted back to the plain schema first, and the
+        result follows the compact and output arguments of this call. Not 
+        available for obs_level = 'us'.
+    prior_end_quarter: str or dict, optional
+        The last quarter covered by prior_df, in the form 'YYYY-QN'. Either a
+        single quarter for all states or a dictionary from state postal code 
+        abbreviation to quarter. States not in the dictionary are fetched in
+        full.
+    max_cells: int or None, default 100000000
+        Memory budget, in estimated number of cells (rows x columns) of the
+        quarterly data. If the estimated size of the pull exceeds this, the data
+        is fetched and cleaned one partition at a time--one state, or for MSAs,
+        one group of states linked by MSAs that cross state lines--so that peak
+        memory scales with the largest partition rather than the full result.
+        If None, the data is always processed at once.
     key: str, default os.getenv("CENSUS_KEY"), optional
         Census API key. See README for instructions on how to get one, if 
         desired. Otherwise, user can pass key=None, which will work until user
@@ -532,7 +763,22 @@ def qwi(
         corresponds to more urls being pulled at a time. The optimal number of
         threads depends on the user's machine and the amount of data being 
         pulled.
+    compact: bool, default False
+        Whether to return the data in a compact schema: categorical
+        identifiers, integer time period codes, and Int32/float32 values. See
+        kauffman.tools.compact_dtypes.
+    output: {'pandas', 'arrow'}, default 'pandas'
+        The type of the returned data. 'arrow' returns a pyarrow.Table with a 
+        stable schema: dictionary-encoded identifiers, an int32 time period 
+        code, and float64 values. Requires pyarrow. See 
+        kauffman.tools.to_arrow. Not available with compact=True.
+    write_to: str, optional
+        A local path or S3 uri to also write the data to, as a Hive-partitioned
+        parquet dataset partitioned by dataset, obs_level, state and year. 
+        Only the partitions covered by this pull are overwritten. Requires 
+        pyarrow. See kauffman.tools.write_dataset.
     """
+    g._check_output(output, compact)
 
     if enforce_release_consistency:
         q.consistent_releases(enforce=True)
@@ -583,18 +829,48 @@ def qwi(
             'If fips_list is provided, obs_level must be either msa or county.'
         )
 
+    if source not in ['api', 'bulk']:
+        raise Exception(
+            f'Invalid input to source: {source}. Must be "api" or "bulk".'
+        )
+
+    if source == 'bulk' and obs_level == 'us':
+        raise Exception(
+            'source="bulk" is only available for obs_level state, msa, or '
+            'county.'
+        )
+
+    if (prior_df is None) != (prior_end_quarter is None):
+        raise Exception(
+            'prior_df and prior_end_quarter must be provided together.'
+        )
+
+    if prior_df is not None and obs_level == 'us':
+        raise Exception(
+            'Incremental refresh is only available for obs_level state, msa, '
+            'or county.'
+        )
+
     estimated_shape = q.estimate_data_shape(
         indicator_list, obs_level, firm_char, worker_char, strata_totals, 
         state_list, fips_list
     )
-    if estimated_shape[0] * estimated_shape[1] > 100000000:
+    partitioned = max_cells is not None and obs_level != 'us' \
+        and estimated_shape[0] * estimated_shape[1] > max_cells
+    if partitioned:
+        print(
+            'Warning: You are attempting to fetch a dataframe of estimated',
+            f'shape {estimated_shape}. The data will be processed in',
+            'partitions to limit memory usage.'
+        )
+    elif estimated_shape[0] * estimated_shape[1] > 100000000:
         print(
             'Warning: You are attempting to fetch a dataframe of estimated',
             f'shape {estimated_shape}. You may experience memory errors.'
         )
 
     # Warn users if they didn't provide a key
-    if key == None:
+    if key == None and source == 'api':
         print('WARNING: You did not provide a key. Too many requests will ' \
             'result in an error.')
 
@@ -609,17 +885,64 @@ def qwi(
             ) \
             ['fips_state'].unique().tolist()
 
-    return _qwi_fetch_data(
-            indicator_list, obs_level, state_list, fips_list, private, 
-            annualize, firm_char, worker_char, key, n_threads
+    state_to_years = q._get_state_to_years(annualize) \
+        if obs_level != 'us' else None
+    prior_df = _plain_prior_data(prior_df, indicator_list, annualize)
+    if prior_df is not None:
+        state_to_years = _years_since_prior(
+            state_to_years, prior_end_quarter, annualize, obs_level, state_list
+        )
+        if all(
+            state_to_years[s]['start_year'] > state_to_years[s]['end_year']
+            for s in state_list
+        ):
+            print('No new quarters have been released since prior_end_quarter.')
+            if output == 'arrow':
+                return g.to_arrow(prior_df, indicator_list)
+            if compact:
+                return g.compact_dtypes(prior_df, indicator_list)
+            return prior_df
+
+    if partitioned:
+        partitions = [
+            (
+                part_states, part_fips, 
+                [s for s in state_list_orig if s in part_states]
+            )
+            for part_states, part_fips in q._state_partitions(
+                state_list, fips_list, obs_level
+            )
+            if any(
+                state_to_years[s]['start_year'] <= state_to_years[s]['end_year']
+                for s in part_states
+            )
+        ]
+    else:
+        partitions = [(state_list, fips_list, state_list_orig)]
+
+    df = pd.concat([
+            _qwi_fetch_data(
+                indicator_list, obs_level, part_states, part_fips, private, 
+                state_to_years, firm_char, worker_char, strata_totals, source,
+                key, n_threads
+            ) \
+            .pipe(
+                _clean_data, indicator_list, obs_level, firm_char, worker_char,
+                strata_totals, annualize, covars, part_states, part_states_orig
+            )
+            for part_states, part_fips, part_states_orig in partitions
+        ]) \
+        .pipe(
+            _merge_prior_data, prior_df, covars, state_to_years, obs_level,
+            state_list
         ) \
-        .drop_duplicates() \
-        .pipe(api._create_fips, obs_level) \
-        .pipe(_cols_to_numeric, indicator_list) \
-        .pipe(_filter_strata_totals, firm_char, worker_char, strata_totals) \
-        .pipe(_aggregate_msas, covars, obs_level) \
-        .pipe(_remove_extra_msas, state_list, state_list_orig) \
-        [covars + indicator_list] \
-        .pipe(_annualize_data, annualize, covars) \
         .sort_values(covars) \
-        .reset_index(drop=True)
\ No newline at end of file
+        .reset_index(drop=True)
+
+    if write_to:
+        g.write_dataset(df, write_to, 'qwi', obs_level, indicator_list)
+    if output == 'arrow':
+        return g.to_arrow(df, indicator_list)
+    if compact:
+        return g.compact_dtypes(df, indicator_list)
+    return df
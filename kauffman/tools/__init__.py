@@ -1,13 +1,20 @@
 from .general_tools import file_to_s3, file_from_s3, aggregate_county_to_msa, \
-    geolevel_crosswalk, CBSA_crosswalk, weighted_sum, as_list
+    crosswalk_aggregate, geolevel_crosswalk, CBSA_crosswalk, weighted_sum, \
+    compact_dtypes, to_arrow, write_dataset, as_list
 from .qwi_tools import consistent_releases, latest_releases, \
     estimate_data_shape, missing_obs
-from .api_tools import fetch_from_url, run_in_parallel \
-    
+from .time_tools import month_to_period, period_codes, fiscal_years, \
+    aggregate_periods
+from .vintage_tools import load_vintage
+from .api_tools import fetch_from_url, run_in_parallel, cached_download
+
 
 __all__ = [
-    'file_to_s3', 'file_from_s3', 'aggregate_county_to_msa',
-    'geolevel_crosswalk', 'CBSA_crosswalk', 'weighted_sum', 'as_list', 
+    'file_to_s3', 'file_from_s3', 'aggregate_county_to_msa', 
+    'crosswalk_aggregate',
+    'geolevel_crosswalk', 'CBSA_crosswalk', 'weighted_sum', 'compact_dtypes',
+    'to_arrow', 'write_dataset', 'as_list', 
     'consistent_releases', 'latest_releases', 'estimate_data_shape',
-    'missing_obs', 'fetch_from_url', 'run_in_parallel'
+    'missing_obs', 'month_to_period', 'period_codes', 'fiscal_years',
+    'aggregate_periods', 'load_vintage', 'fetch_from_url', 'run_in_parallel', 'cached_download'
 ]
\ No newline at end of file
@@ -1,3 +1,6 @@
+import os
+import json
+import filecmp
 import pandas as pd
 import requests
 import re
@@ -40,18 +43,114 @@ def fetch_from_url(url, session):
     return df
 
 
-def run_in_parallel(data_fetch_fn, groups, constant_inputs, n_threads):
-    s = requests.Session()
+def _get(url, session):
+    # Fetches a (non-API) file with the same retry policy as fetch_from_url
+    retries = 0
+    while retries < 5:
+        try:
+            r = session.get(url)
+            if r.status_code == 200:
+                return r
+            elif r.status_code == 404:
+                raise Exception(f'error: Status code 404 for url {url}')
+            print(f'Fail. Attempt #{retries + 1}/5', 'Status code:', r, url)
+        except Exception as e:
+            if str(e).startswith('error'):
+                raise e
+            print(f'Fail. Attempt #{retries + 1}/5', e)
+        retries += 1
+    raise Exception(f'Maxed out retries with url: {url}')
+
+
+def cached_download(url, path, session=None):
+    """
+    Download a file to a local cache, revalidating any existing copy with the
+    server (If-None-Match/If-Modified-Since) instead of downloading it again.
+    The file is only rewritten when its contents change, so its modification
+    time can be used to invalidate anything derived from it. If the server 
+    cannot be reached or returns an error, an existing copy is used with a 
+    warning.
+
+    Parameters
+    ----------
+    url: str
+        The url of the file.
+    path: str
+        The local path of the cached copy. The response validators are stored 
+        alongside it in path + '.json'.
+    session: requests.Session, optional
+        The session to use for the request.
+
+    Returns
+    -------
+    The local path of the file.
+    """
+    meta_path = path + '.json'
+    meta = {}
+    if os.path.exists(path) and os.path.exists(meta_path):
+        with open(meta_path) as f:
+            meta = json.load(f)
+
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+
+    try:
+        r = (session or requests).get(url, headers=headers, stream=True)
+    except requests.exceptions.RequestException as e:
+        if os.path.exists(path):
+            print(f'Could not revalidate {url} ({e}), using cached copy.')
+            return path
+        raise e
+    if r.status_code == 304:
+        return path
+    if r.status_code != 200:
+        if os.path.exists(path):
+            print(
+                f'Could not revalidate {url} (status code {r.status_code}),',
+                'using cached copy.'
+            )
+            return path
+        raise Exception(f'Fail. Status code: {r.status_code} for url {url}')
+
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        for chunk in r.iter_content(chunk_size=1 << 20):
+            f.write(chunk)
+    if os.path.exists(path) and filecmp.cmp(tmp_path, path, shallow=False):
+        os.remove(tmp_path)
+    else:
+        os.replace(tmp_path, path)
+
+    with open(meta_path, 'w') as f:
+        json.dump(
+            {
+                'etag':r.headers.get('ETag'),
+                'last_modified':r.headers.get('Last-Modified')
+            },
+            f
+        )
+    return path
+
+
+def run_in_parallel(
+    data_fetch_fn, groups, constant_inputs, n_threads, concat=True, 
+    session=None
+):
+    # A session passed in is shared with the caller, so it is left open
+    s = session if session else requests.Session()
     parallel = Parallel(n_jobs=n_threads, backend='threading')
     with parallel:
-        df = pd.concat(
-            parallel(
-                delayed(data_fetch_fn)(g, *constant_inputs, s)
-                for g in groups
-            )
+        dfs = parallel(
+            delayed(data_fetch_fn)(g, *constant_inputs, s) for g in groups
         )
-    s.close()
-    return df
+    if not session:
+        s.close()
+    # concat=False returns the results in the order of groups
+    return pd.concat(dfs) if concat else dfs
 
 
 def _create_fips(df, obs_level):
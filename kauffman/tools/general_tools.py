@@ -1,6 +1,8 @@
 import io
 import boto3
+import functools
 import requests
+import numpy as np
 import pandas as pd
 from kauffman import constants as c
 from zipfile import ZipFile
@@ -94,27 +96,190 @@ def CBSA_crosswalk():
     return df_cw
 
 
-def aggregate_county_to_msa(df_county, fips_county, outcomes, agg_method=sum):
+def _crosswalk_index(cw, from_col, to_cols, cw_weight=None):
+    # Integer-indexed form of a crosswalk: the (from, to, weight) pairs sorted
+    # by from code, with the offset of each from code's block of pairs
+    cw = cw.drop_duplicates([from_col, to_cols[0]])
+    from_codes, from_uniques = pd.factorize(cw[from_col])
+    to_codes, to_uniques = pd.factorize(cw[to_cols[0]], sort=True)
+    order = np.argsort(from_codes, kind='stable')
+    n_pairs = np.bincount(from_codes, minlength=len(from_uniques))
+    return {
+        'from':pd.Index(from_uniques),
+        'to':pd.DataFrame({to_cols[0]:to_uniques}) \
+            .merge(
+                cw[to_cols].drop_duplicates(to_cols[0]), how='left', 
+                on=to_cols[0]
+            ),
+        'pair_to':to_codes[order],
+        'pair_weight':np.ones(len(cw)) if cw_weight is None \
+            else cw[cw_weight].to_numpy(dtype=float)[order],
+        'n_pairs':n_pairs,
+        'offsets':np.cumsum(n_pairs) - n_pairs,
+        'n_expected':np.bincount(to_codes, minlength=len(to_uniques))
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _cbsa_county_index():
+    return _crosswalk_index(
+        CBSA_crosswalk(), 'fips_county', ['fips_msa', 'CBSA Title']
+    )
+
+
+def _aggregate_with_index(
+    df, fips_col, outcomes, index, by, weight_var, mean, coverage
+):
+    # Each data row is expanded to its crosswalk pairs, and every
+    # (to, by, outcome) cell is reduced in a single bincount
+    from_idx = index['from'].get_indexer(df[fips_col])
+    matched = np.flatnonzero(from_idx >= 0)
+    n_pairs = index['n_pairs'][from_idx[matched]]
+    rows = np.repeat(matched, n_pairs)
+    pairs = np.repeat(
+            index['offsets'][from_idx[matched]] - np.cumsum(n_pairs) + n_pairs,
+            n_pairs
+        ) \
+        + np.arange(len(rows))
+
+    by_idx = df.groupby(by, sort=True, dropna=False).ngroup().to_numpy() \
+        if by else np.zeros(len(df), dtype=int)
+    by_keys = df[by].drop_duplicates().sort_values(by).reset_index(drop=True)
+    n_by = max(len(by_keys), 1)
+    n_cells = len(index['to']) * n_by
+    cell = index['pair_to'][pairs] * n_by + by_idx[rows]
+
+    values = df[outcomes].apply(pd.to_numeric).to_numpy(dtype=float)[rows]
+    weights = index['pair_weight'][pairs] * (
+        1 if weight_var is None else df[weight_var].to_numpy(dtype=float)[rows]
+    )
+    observed = ~np.isnan(values)
+    k = len(outcomes)
+    cell_outcome = (cell[:, None] * k + np.arange(k)).ravel()
+    totals = np.bincount(
+            cell_outcome,
+            weights=np.where(observed, values * weights[:, None], 0).ravel(),
+            minlength=n_cells * k
+        ) \
+        .reshape(n_cells, k)
+    if mean:
+        with np.errstate(invalid='ignore', divide='ignore'):
+            totals = totals / np.bincount(
+                    cell_outcome,
+                    weights=np.where(observed, weights[:, None], 0).ravel(),
+                    minlength=n_cells * k
+                ) \
+                .reshape(n_cells, k)
+
+    present = np.flatnonzero(np.bincount(cell, minlength=n_cells) > 0)
+    df_out = pd.concat(
+        [
+            index['to'].iloc[present // n_by].reset_index(drop=True),
+            by_keys.iloc[present % n_by].reset_index(drop=True) if by \
+                else pd.DataFrame(index=range(len(present))),
+            pd.DataFrame(totals[present], columns=outcomes)
+        ],
+        axis=1
+    )
+    if coverage:
+        n_observed = np.bincount(
+            cell, weights=observed.any(axis=1), minlength=n_cells
+        )
+        df_out['coverage'] = n_observed[present] \
+            / index['n_expected'][present // n_by]
+    return df_out
+
+
+def crosswalk_aggregate(
+    df, fips_col, outcomes, cw, from_col, to_cols, by=['time'], 
+    cw_weight=None, weight_var=None, mean=False, coverage=False
+):
     """
-    Receives county level data, and merges (on county fips) with a dataframe 
-    with CBSA codes.
+    Aggregates data from one geographic level to another (ex: county to MSA
+    or state) through a crosswalk. The crosswalk is indexed once into integer
+    codes, and all outcomes are aggregated at once with bincount, rather than 
+    with a merge and groupby.
+
+    Parameters
+    ----------
+    df: DataFrame
+        The data to aggregate.
+    fips_col: str
+        The column of df identifying the geography to aggregate from.
+    outcomes: list
+        The columns to aggregate. Missing values are skipped.
+    cw: DataFrame
+        The crosswalk, with one row per (from, to) pair.
+    from_col: str
+        The column of cw matching fips_col.
+    to_cols: list
+        The columns of cw describing the geography to aggregate to. The first
+        one identifies it, and the rest (ex: a title) are carried along.
+    by: list, default ['time']
+        Other columns of df to aggregate within.
+    cw_weight: str, optional
+        A column of cw with the share of each from geography that is allocated
+        to the to geography. Defaults to 1.
+    weight_var: str, optional
+        A column of df to weight the outcomes by.
+    mean: bool, default False
+        Whether to return weighted means rather than weighted sums.
+    coverage: bool, default False
+        Whether to add a coverage column: the share of the to geography's
+        crosswalk members that have data in the cell, which flags aggregates 
+        built from an incomplete set of counties.
+
+    Returns
+    -------
+    DataFrame
+        One row per (to geography, by) cell with data, with to_cols, by, and 
+        outcomes.
+    """
+    return _aggregate_with_index(
+        df, fips_col, list(outcomes),
+        _crosswalk_index(cw, from_col, to_cols, cw_weight), by, weight_var,
+        mean, coverage
+    )
+
+
+def aggregate_county_to_msa(
+    df_county, fips_county, outcomes, agg_method=sum, weight_var=None, 
+    coverage=False
+):
+    """
+    Receives county level data, and aggregates it to the MSA level using the
+    CBSA crosswalk. Sums and means go through crosswalk_aggregate, and any 
+    other agg_method through a merge with the crosswalk and a groupby.
 
     fips_county: fips column name
+    agg_method: any aggregation accepted by DataFrameGroupBy.agg
+    weight_var: optional column to weight the outcomes by (sum or mean only)
+    coverage: whether to add the share of each MSA's counties with data (sum
+        or mean only)
     """
     outcomes = list(outcomes)
-    df_county[outcomes] = df_county[outcomes].apply(pd.to_numeric)
-
-    df_cw = CBSA_crosswalk()
+    if any(agg_method is f for f in [sum, np.sum, np.mean]) \
+        or agg_method in ['sum', 'mean']:
+        return _aggregate_with_index(
+                df_county, fips_county, outcomes, _cbsa_county_index(), 
+                ['time'], weight_var, agg_method in [np.mean, 'mean'], 
+                coverage
+            ) \
+            .rename(columns={'CBSA Title': 'region', 'fips_msa':'fips'})
 
+    if weight_var or coverage:
+        raise Exception(
+            'weight_var and coverage are only available for agg_method sum '
+            'or "mean".'
+        )
     return df_county \
+        .assign(**{col:pd.to_numeric(df_county[col]) for col in outcomes}) \
         .rename(columns={fips_county: 'fips_county'}) \
-        .merge(df_cw, how='left', on='fips_county') \
+        .merge(CBSA_crosswalk(), how='left', on='fips_county') \
         [['fips_msa', 'CBSA Title', 'time'] + outcomes] \
         .groupby(['fips_msa', 'CBSA Title', 'time']).agg(agg_method) \
         .reset_index(drop=False) \
         .rename(columns={'CBSA Title': 'region', 'fips_msa':'fips'})
-# todo: I can't just groupby and sum wrt cw(), since there might be missing 
-# county values
 
 
 def geolevel_crosswalk(
@@ -169,18 +334,281 @@ def geolevel_crosswalk(
         .reset_index(drop=True)
 
 
-def weighted_sum(df, strata = [], var_list = 'all', weight_var=None):
+def _is_int(x):
+    return pd.api.types.is_integer_dtype(x) or pd.api.types.is_bool_dtype(x)
+
+
+def _group_sums(groups, x, n_groups):
+    return np.bincount(groups, weights=x, minlength=n_groups + 1)[:-1]
+
+
+def weighted_sum(df, strata=[], var_list='all', weight_var=None, mean=False):
+    """
+    Sums (or averages) variables within strata, weighting each variable by a
+    weight column. The strata are coded once and each variable is reduced with
+    a bincount on a view of its column, so df is neither copied nor changed.
+
+    df: DataFrame
+    strata: str or list
+        The columns to group by
+    var_list: list or 'all', default 'all'
+        The columns to aggregate. If 'all', every column that is not in strata
+        and not a weight column.
+    weight_var: str or dict, optional
+        The weight column, or a dict mapping each variable to its own weight
+        column (variables left out are unweighted). If None, the variables are
+        unweighted.
+    mean: bool, default False
+        Whether to return weighted means, i.e. the weighted sum divided by the
+        sum of the weights of the non-missing values, instead of weighted sums.
+        Groups whose weights sum to zero get NaN.
+
+    Weighted sums of integer variables with integer (or no) weights keep an 
+    integer type, as with a groupby sum. Everything else is float64.
+    """
     strata = [strata] if type(strata) == str else strata
+    var_to_weight = weight_var if type(weight_var) == dict else {}
+    weight_cols = set(var_to_weight.values()) if var_to_weight \
+        else {weight_var} - {None}
     if var_list == 'all':
-        var_list = [x for x in df.columns if x not in strata]
-    if weight_var == None:
-        weight_var = 'weight'
-        df['weight'] = 1
-    
-    return df[strata + var_list] \
-        .apply(lambda x: x*df[weight_var] if x.name in var_list else x) \
-        .groupby(strata).sum() \
-        .reset_index()
+        var_list = [
+            x for x in df.columns if x not in strata and x not in weight_cols
+        ]
+    if not var_to_weight:
+        var_to_weight = {var:weight_var for var in var_list}
+
+    # Strata are coded as integers once, and each variable is then weighted
+    # and reduced with a bincount straight from a view of its column, so that
+    # no copy of the frame (or of its value block) is made
+    codes, uniques = zip(*[pd.factorize(df[col], sort=True) for col in strata])
+    keep = np.all([code >= 0 for code in codes], axis=0)
+    cells, inverse = np.unique(
+        np.ravel_multi_index(
+            [code[keep] for code in codes], [len(u) for u in uniques]
+        ),
+        return_inverse=True
+    )
+    # Rows with missing strata go to an extra group that is dropped
+    groups = np.full(len(df), len(cells))
+    groups[keep] = inverse.ravel()
+
+    totals, denominators, int_dtypes = [], [], {}
+    for var in var_list:
+        values = df[var].to_numpy(dtype=float, na_value=np.nan)
+        weights = np.ones(len(df)) if var_to_weight.get(var) is None \
+            else df[var_to_weight[var]].to_numpy(dtype=float, na_value=np.nan)
+        if not mean and _is_int(df[var]) and (
+            var_to_weight.get(var) is None or _is_int(df[var_to_weight[var]])
+        ):
+            int_dtypes[var] = 'Int64' \
+                if isinstance(df[var].dtype, pd.api.extensions.ExtensionDtype) \
+                else 'int64'
+        observed = ~np.isnan(values)
+        totals.append(_group_sums(
+            groups, np.where(observed, values * weights, 0), len(cells)
+        ))
+        if mean:
+            denominators.append(_group_sums(
+                groups, np.where(observed, weights, 0), len(cells)
+            ))
+    totals = np.column_stack(totals)
+    if mean:
+        with np.errstate(divide='ignore', invalid='ignore'):
+            totals = totals / np.column_stack(denominators)
+        totals[np.column_stack(denominators) == 0] = np.nan
+
+    keys = np.unravel_index(cells, [len(u) for u in uniques])
+    return pd.concat(
+        [
+            pd.DataFrame({
+                col:np.asarray(u)[key]
+                for col, u, key in zip(strata, uniques, keys)
+            }),
+            pd.DataFrame(totals, columns=var_list).astype(int_dtypes)
+        ],
+        axis=1
+    )
+
+
+def _compact_values(x):
+    x = pd.to_numeric(x, errors='coerce')
+    values = x.dropna()
+    if not (values == values.round()).all():
+        return x.astype('float32')
+    elif values.empty or values.abs().max() < 2**31:
+        return x.astype('Int32')
+    return x.astype('Int64')
+
+
+def _compact_time(x):
+    # Period codes are nullable, so a missing time stays missing
+    if pd.api.types.is_datetime64_any_dtype(x):
+        return (x.dt.year * 100 + x.dt.month).astype('Int32')
+    elif pd.api.types.is_numeric_dtype(x):
+        return x.astype('Int16')
+    # Only 'YYYY-QN' strings are quarterly, other strings are plain years
+    codes, uniques = pd.factorize(x)
+    uniques = pd.Series(uniques).astype(str)
+    if uniques.str.fullmatch(r'\d{4}-Q[1-4]').all():
+        periods = (
+            uniques.str[:4].astype('int32') * 10 
+            + uniques.str[-1:].astype('int32')
+        ).to_numpy()
+        dtype = 'Int32'
+    else:
+        periods = pd.to_numeric(uniques).to_numpy()
+        dtype = 'Int16'
+    return pd.Series(
+            np.append(periods, 0)[codes], index=x.index, dtype=dtype
+        ) \
+        .mask(codes < 0)
+
+
+def compact_dtypes(df, value_cols, time_col='time'):
+    """
+    Converts a dataframe from this library to a compact schema:
+    * value_cols become nullable Int32 (or Int64, if out of the Int32 range)
+        when they only hold whole numbers, and float32 otherwise
+    * time_col becomes a nullable integer period code: the year (Int16) for
+        annual data, YYYYQ (Int32) for quarterly 'YYYY-QN' strings, and 
+        YYYYMM (Int32) for monthly dates
+    * All remaining string columns (fips, region, industry, strata, etc.)
+        become categoricals, and all remaining numeric columns are downcast
+
+    df: DataFrame
+    value_cols: list
+        The columns holding the data values
+    time_col: str, default 'time'
+        The column holding the time period
+    """
+    return df.apply(
+        lambda x: _compact_values(x) if x.name in value_cols \
+            else _compact_time(x) if x.name == time_col \
+            else pd.to_numeric(x, downcast='integer') \
+                if pd.api.types.is_numeric_dtype(x) \
+            else x.astype('category')
+    )
+
+
+def _arrow_column(x, pa, value_cols, time_col):
+    if x.name in value_cols:
+        x = pd.to_numeric(x, errors='coerce') \
+            .to_numpy('float64', na_value=np.nan)
+        return pa.array(x, from_pandas=True)
+    elif x.name == time_col:
+        return pa.array(_compact_time(x).astype('Int32'), type=pa.int32())
+    elif pd.api.types.is_numeric_dtype(x) or pd.api.types.is_bool_dtype(x):
+        return pa.array(x, from_pandas=True)
+    # Identifiers are dictionary encoded straight from their factorized codes
+    codes, uniques = pd.factorize(x)
+    return pa.DictionaryArray.from_arrays(
+        pa.array(codes.astype('int32'), mask=codes < 0),
+        pa.array(uniques.astype(str), type=pa.string())
+    )
+
+
+def _import_pyarrow():
+    # pyarrow is an optional dependency, only needed for the arrow output and 
+    # the dataset writer
+    try:
+        import pyarrow as pa
+        import pyarrow.dataset
+    except ImportError:
+        raise Exception(
+            'pyarrow is required for this option. Install it with '
+            '"pip install pyarrow" or "pip install kauffman[arrow]".'
+        )
+    return pa
+
+
+def _check_output(output, compact):
+    # Validates the output options shared by the dataset functions, before
+    # anything is fetched
+    if output not in ['pandas', 'arrow']:
+        raise Exception(f'Invalid output: {output}. Use "pandas" or "arrow".')
+    if output == 'arrow' and compact:
+        raise Exception(
+            'compact is not available with output="arrow", whose schema is '
+            'already compact. See kauffman.tools.to_arrow.'
+        )
+
+
+def to_arrow(df, value_cols, time_col='time'):
+    """
+    Converts a dataframe from this library to a pyarrow Table with a stable 
+    schema, built column by column from the underlying arrays:
+    * value_cols become float64, with missing values as nulls
+    * time_col becomes an int32 period code, as in compact_dtypes
+    * All remaining string columns become dictionary<int32, string>, and 
+        remaining numeric columns keep their type
+
+    Requires pyarrow.
+
+    df: DataFrame
+    value_cols: list
+        The columns holding the data values
+    time_col: str, default 'time'
+        The column holding the time period
+    """
+    pa = _import_pyarrow()
+    return pa.Table.from_arrays(
+        [_arrow_column(df[col], pa, value_cols, time_col) for col in df],
+        names=[str(col) for col in df.columns]
+    )
+
+
+def _partition_year(x):
+    if pd.api.types.is_datetime64_any_dtype(x):
+        return x.dt.year.astype('int32')
+    elif pd.api.types.is_numeric_dtype(x):
+        return x.astype('int32')
+    return x.astype(str).str[:4].astype('int32')
+
+
+def write_dataset(df, path, dataset, obs_level, value_cols, time_col='time'):
+    """
+    Writes a dataframe from this library to a Hive-partitioned parquet 
+    dataset, partitioned by dataset, obs_level, state and year. For example:
+    path/dataset=qwi/obs_level=county/state=01/year=2019/part-0.parquet
+    The state is the first two digits of fips for state and county data, and
+    '00' otherwise. Only the partitions present in df are overwritten, so a 
+    repeated pull replaces just the states and years it covers. The schema is 
+    the one from to_arrow. Requires pyarrow.
+
+    df: DataFrame
+    path: str
+        The root directory of the dataset, either a local path or an S3 uri
+        (Ex: 's3://emkf.data.research/indicators/datasets')
+    dataset: str
+        The name of the dataset (Ex: 'qwi')
+    obs_level: str
+        The geographical level of the data
+    value_cols: list
+        The columns holding the data values
+    time_col: str, default 'time'
+        The column holding the time period
+
+    Examples:
+        from kauffman.tools import write_dataset
+        write_dataset(df, 's3://emkf.data.research/datasets', 'pep', 'state', 
+        ['population'])
+    """
+    pa = _import_pyarrow()
+    partition_cols = ['dataset', 'obs_level', 'state', 'year']
+    state = df['fips'].astype(str).str[:2] \
+        if obs_level in ['state', 'county'] else '00'
+    table = to_arrow(
+        df.assign(
+            dataset=dataset, obs_level=obs_level, state=state, 
+            year=_partition_year(df[time_col])
+        ), 
+        value_cols, time_col
+    )
+    pa.dataset.write_dataset(
+        table, path, format='parquet', partitioning=partition_cols, 
+        partitioning_flavor='hive', basename_template='part-{i}.parquet',
+        existing_data_behavior='delete_matching'
+    )
 
 
 def as_list(object):
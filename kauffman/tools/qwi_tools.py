@@ -1,4 +1,5 @@
 import requests
+import numpy as np
 import pandas as pd
 from joblib import Parallel, delayed
 from kauffman import constants as c
@@ -93,6 +94,32 @@ def _get_state_to_years(annualize=None):
         .to_dict('index')
 
 
+def _state_to_years_since(state_to_years, prior_end_quarter, annualize):
+    if type(prior_end_quarter) == str:
+        prior_end_quarter = {s:prior_end_quarter for s in c.STATES}
+    prior_end_quarter = {
+        c.STATE_ABB_TO_FIPS[k]:v for k,v in prior_end_quarter.items()
+    }
+
+    out_dict = {}
+    for state, years in state_to_years.items():
+        if state not in prior_end_quarter:
+            out_dict[state] = years
+            continue
+
+        year = int(prior_end_quarter[state][:4])
+        quarter = int(prior_end_quarter[state][-1:])
+        year, quarter = (year + 1, 1) if quarter == 4 else (year, quarter + 1)
+        if annualize == 'April' and quarter == 1:
+            year -= 1
+
+        out_dict[state] = {
+            'start_year': max(years['start_year'], year),
+            'end_year': years['end_year']
+        }
+    return out_dict
+
+
 def estimate_data_shape(
     indicator_list, obs_level, firm_char, worker_char, strata_totals, 
     state_list, fips_list
@@ -147,12 +174,66 @@ def estimate_data_shape(
     return (row_estimate, n_columns)
 
 
-def _map_state_to_years(state, d):
-    return list(range(d[state]['start_year'], d[state]['end_year'] + 1))
+def _merge_state_clusters(state_sets):
+    clusters = []
+    for states in state_sets:
+        overlapping = [cluster for cluster in clusters if cluster & states]
+        clusters = [cluster for cluster in clusters if not cluster & states] \
+            + [set(states).union(*overlapping)]
+    return clusters
+
+
+def _state_partitions(state_list, fips_list, obs_level):
+    # Each partition is a (state_list, fips_list) pair that can be fetched and
+    # cleaned independently: one per state, or, for MSAs, one per group of
+    # states linked by MSAs that cross state lines
+    if obs_level == 'county' and fips_list:
+        states = list(dict.fromkeys(fips[:2] for fips in fips_list))
+        return [
+            ([state], [fips for fips in fips_list if fips[:2] == state])
+            for state in states
+        ]
+    elif obs_level != 'msa':
+        return [([state], []) for state in state_list]
+
+    if fips_list:
+        msa_to_states = {
+            msa:set(c.MSA_TO_STATE_FIPS[msa]) 
+            for msa in fips_list if msa in c.MSA_TO_STATE_FIPS
+        }
+        return [
+            (
+                sorted(cluster), 
+                [
+                    msa for msa, states in msa_to_states.items() 
+                    if states <= cluster
+                ]
+            )
+            for cluster in _merge_state_clusters(msa_to_states.values())
+        ]
+
+    clusters = _merge_state_clusters(
+        [set(state_list) & set(states) for states in c.MSA_TO_STATE_FIPS.values()]
+        + [{state} for state in state_list]
+    )
+    return [(sorted(cluster), []) for cluster in clusters if cluster]
+
+
+def _key_codes(df, keys, key_to_levels):
+    codes = [
+        pd.Index(key_to_levels[k]).get_indexer(df[k]) for k in keys
+    ]
+    valid = np.logical_and.reduce([code >= 0 for code in codes])
+    return np.ravel_multi_index(
+        [code[valid] for code in codes], 
+        [len(key_to_levels[k]) for k in keys]
+    )
 
 
-def missing_obs(df, geo_level, state_list, fips_list, worker_char, firm_char, 
-annualize, strata_totals):
+def missing_obs(
+    df, geo_level, state_list, fips_list, worker_char, firm_char, annualize, 
+    strata_totals, counts=False
+):
     """
     Finds the observations that are expected in the QWI data but not present.
 
@@ -166,63 +247,88 @@ annualize, strata_totals):
         The worker characteristics the data is stratified by
     firm_char : list
         The firm characteristics the data is stratified by
+    counts : bool, default False
+        Whether to return the number of missing observations per fips code 
+        instead of the missing observations themselves
 
     Returns
     -------
     DataFrame
-        The index of the missing observations
+        The index of the missing observations, or their counts by fips
     """
+    strata = worker_char + firm_char
+    strata_to_levels = {
+        s:[str(l) for l in levels[(0 if strata_totals else 1):]]
+        for s, levels in c.QWI_STRATA_TO_LEVELS.items() if s in strata
+    }
+
     if geo_level == 'us':
-        expected_index = pd.DataFrame({'time':list(range(1990, 2021))}) \
-            .assign(fips='01')
+        state_to_fips = {'00': ['00']}
+        state_to_years = {'00': {'start_year': 1990, 'end_year': 2020}}
     else:
         state_to_years = _get_state_to_years(annualize)
         state_list = c.STATES if state_list == 'all' else state_list
         state_list = [c.STATE_ABB_TO_FIPS[s] for s in state_list]
-        fips_cols = list({'fips_state', f'fips_{geo_level}'})
 
-        expected_index = CBSA_crosswalk() \
-            [fips_cols] \
+        cw = CBSA_crosswalk() \
+            [list({'fips_state', f'fips_{geo_level}'})] \
             .query(f'fips_state in {state_list}')
         if fips_list:
-            expected_index = expected_index \
-                .query(f'fips_{geo_level} in {fips_list}')
-            
-        expected_index = expected_index \
+            cw = cw.query(f'fips_{geo_level} in {fips_list}')
+        state_to_fips = cw \
             .drop_duplicates() \
-            .assign(
-                time=lambda x: x.fips_state.apply(
-                    _map_state_to_years, 
-                    args=[state_to_years]
-                )
-            ) \
-            .explode('time')
+            .groupby('fips_state')[f'fips_{geo_level}'] \
+            .apply(list) \
+            .to_dict()
 
-        strata = worker_char + firm_char
-        strata_dict = c.QWI_STRATA_TO_LEVELS if strata_totals else {
-            k:v[1:] for k,v in c.QWI_STRATA_TO_LEVELS.items()
-        }
-        for s in strata:
-            expected_index[s] = [strata_dict[s]] * len(expected_index)
-            expected_index = expected_index.explode(s)
+    # Each key is coded as an integer position within its levels, so that the
+    # expected set is a cartesian product of small integer arrays and the 
+    # anti-join runs on a single int64 per observation
+    keys = ['fips', 'time'] + strata + ([] if annualize else ['quarter'])
+    first_year = min(state_to_years[s]['start_year'] for s in state_to_fips)
+    last_year = max(state_to_years[s]['end_year'] for s in state_to_fips)
+    key_to_levels = {
+        'fips': sorted({f for fips in state_to_fips.values() for f in fips}),
+        'time': list(range(first_year, last_year + 1)),
+        'quarter': [1, 2, 3, 4],
+        **strata_to_levels
+    }
+    dims = [len(key_to_levels[k]) for k in keys]
 
-        expected_index = expected_index \
-            .assign(fips=lambda x:x[f'fips_{geo_level}']) \
-            .drop(columns=fips_cols)
+    expected = np.concatenate([
+        np.ravel_multi_index(
+            np.ix_(
+                pd.Index(key_to_levels['fips']).get_indexer(fips),
+                np.arange(
+                    state_to_years[state]['start_year'] - first_year,
+                    state_to_years[state]['end_year'] - first_year + 1
+                ),
+                *[np.arange(dim) for dim in dims[2:]]
+            ),
+            dims
+        ).ravel()
+        for state, fips in state_to_fips.items()
+    ])
 
-    if not annualize:
-        expected_index = expected_index.assign(
-                quarter=[[1,2,3,4]]*len(expected_index)
-            ) \
-            .explode('quarter')
+    if not annualize and 'quarter' not in df.columns:
+        df = df.assign(
+            quarter=lambda x: x['time'].str[-1:].astype(int),
+            time=lambda x: x['time'].str[:4]
+        )
+    df = df.astype({
+        **{'time':int, 'fips':str}, 
+        **{k:str for k in strata},
+        **({} if annualize else {'quarter':int})
+    })
 
-    var_to_dtypes = {**{'time':int, 'fips':str}, **{var:str for var in strata}}
-    expected_index = expected_index \
-        .astype(var_to_dtypes) \
-        .reset_index(drop=True)
+    missing = expected[~np.isin(expected, _key_codes(df, keys, key_to_levels))]
+    df_missing = pd.DataFrame({
+        k:np.asarray(key_to_levels[k])[codes]
+        for k, codes in zip(keys, np.unravel_index(missing, dims))
+    })
 
-    return df[[c for c in expected_index.columns]] \
-            .merge(expected_index, how='right', indicator=True) \
-            .query('_merge != "both"') \
-            .drop(columns='_merge') \
-            .reset_index(drop=True)
\ No newline at end of file
+    if counts:
+        return df_missing \
+            .groupby('fips').size() \
+            .reset_index(name='n_missing')
+    return df_missing
@@ -0,0 +1,187 @@
+import numpy as np
+import pandas as pd
+
+
+MONTHS = [
+    'January', 'February', 'March', 'April', 'May', 'June', 'July', 'August',
+    'September', 'October', 'November', 'December'
+]
+
+
+def _is_text(x):
+    # Strings are object columns, or the string dtype (the default in pandas 3)
+    return pd.api.types.is_object_dtype(x) or pd.api.types.is_string_dtype(x)
+
+
+def _parse_periods(time, periods_per_year):
+    # Only the unique values are parsed, then broadcast back with the codes
+    codes, uniques = pd.factorize(time)
+    years = np.array([int(t[:4]) for t in uniques], dtype='int32')
+    if periods_per_year == 12:
+        periods = np.array([int(t[5:7]) for t in uniques], dtype='int8')
+    else:
+        periods = np.array([int(t[-1:]) for t in uniques], dtype='int8')
+    return years[codes], periods[codes]
+
+
+def month_to_period(month, periods_per_year=4):
+    """
+    Map months to the period of the year that they fall in.
+
+    Parameters
+    ----------
+    month: array-like of int or str
+        Month numbers (1-12) or full month names (Ex: 'March').
+    periods_per_year: {1, 2, 4, 12}, default 4
+        The number of periods in a year. For example, 4 maps months to
+        quarters.
+    """
+    month = pd.Series(month)
+    if _is_text(month):
+        month = month.map({m:i + 1 for i, m in enumerate(MONTHS)})
+    return ((month.to_numpy() - 1) // (12 // periods_per_year) + 1) \
+        .astype('int8')
+
+
+def period_codes(time, periods_per_year=4, period=None):
+    """
+    Split a time column into integer year and period-of-year arrays.
+
+    Parameters
+    ----------
+    time: pd.Series
+        The time column. Either datetimes, strings starting with the year and
+        ending with the quarter (Ex: '2019-Q3'), 'YYYY-MM' strings when
+        periods_per_year is 12, or integer years when period is given.
+    periods_per_year: {1, 2, 4, 12}, default 4
+        The number of periods in a year.
+    period: pd.Series, optional
+        The period of the year, if it is stored separately from the year. Month
+        names are mapped to periods with month_to_period.
+    """
+    if period is not None:
+        if _is_text(period):
+            period = month_to_period(period, periods_per_year)
+        return time.to_numpy().astype('int32'), \
+            np.asarray(period).astype('int8')
+    if pd.api.types.is_datetime64_any_dtype(time):
+        return time.dt.year.to_numpy().astype('int32'), \
+            month_to_period(time.dt.month, periods_per_year)
+    return _parse_periods(time, periods_per_year)
+
+
+def fiscal_years(year, period, periods_per_year=4, start=1, label='start'):
+    """
+    Assign periods to (possibly shifted) years.
+
+    Parameters
+    ----------
+    year: array-like of int
+        The calendar year of each observation.
+    period: array-like of int
+        The period of the year of each observation.
+    periods_per_year: {1, 2, 4, 12}, default 4
+        The number of periods in a year.
+    start: int, default 1
+        The first period of the year. For example, start=2 with quarterly data
+        gives years running Q2 through Q1.
+    label: {'start', 'end'}, default 'start'
+        Whether a shifted year is labeled by the calendar year it starts in or
+        the one it ends in.
+    """
+    year, period = np.asarray(year), np.asarray(period)
+    if start == 1 or periods_per_year == 1:
+        return year
+    if label == 'start':
+        return year - (period < start)
+    return year + (period >= start)
+
+
+def aggregate_periods(
+    df, index_cols, value_cols, periods_per_year=4, time_col='time',
+    period_col=None, start=1, label='start', min_count=None,
+    drop_incomplete=False, weights={}
+):
+    """
+    Aggregate sub-annual data to years in a single grouped reduction.
+
+    Parameters
+    ----------
+    df: pd.DataFrame
+        The data to aggregate.
+    index_cols: list
+        The identifying columns other than time. The output is unique on these
+        and time_col.
+    value_cols: list
+        The columns to aggregate. These are summed, unless they are in weights.
+    periods_per_year: {2, 4, 12}, default 4
+        The number of periods in a year of the input data.
+    time_col: str, default 'time'
+        The time column, in any format accepted by period_codes. In the output
+        it holds the integer year.
+    period_col: str, optional
+        The column holding the period of the year, if it is not part of
+        time_col. It is dropped from the output.
+    start: int, default 1
+        The first period of the year. See fiscal_years.
+    label: {'start', 'end'}, default 'start'
+        How shifted years are labeled. See fiscal_years.
+    min_count: int, optional
+        The number of non-missing periods a value needs, otherwise it is set to
+        missing. Defaults to periods_per_year.
+    drop_incomplete: bool, default False
+        Whether to drop the years with fewer than periods_per_year
+        observations.
+    weights: dict, default {}
+        Maps a value column to the column to weight it by. These columns are
+        averaged, weighted by the annual sum of the weight column, instead of
+        summed. A weight of None gives an unweighted mean.
+    """
+    min_count = periods_per_year if min_count is None else min_count
+    year, period = period_codes(
+        df[time_col], periods_per_year,
+        df[period_col] if period_col else None
+    )
+
+    # Weighted means are carried through the sum as numerator/denominator
+    # columns, and the period counter rides along for the completeness check
+    weighted = {
+        col:f'_w_{col}' if w is None else w for col, w in weights.items()
+    }
+    helpers = {
+        f'_w_{col}':1 for col, w in weights.items() if w is None
+    }
+    numerators = {
+        f'_num_{col}':df[col] * (1 if w is None else df[w])
+        for col, w in weights.items()
+    }
+    sum_cols = list(dict.fromkeys(
+        [col for col in value_cols if col not in weights] \
+        + [w for w in weighted.values() if w not in helpers] \
+        + list(helpers) + list(numerators)
+    ))
+    df = df \
+        .assign(
+            **{time_col:fiscal_years(
+                year, period, periods_per_year, start, label
+            )},
+            **helpers, **numerators, _n_periods=1
+        ) \
+        [index_cols + [time_col] + sum_cols + ['_n_periods']] \
+        .groupby(index_cols + [time_col]) \
+        .sum(min_count=min_count)
+
+    if drop_incomplete:
+        df = df[df['_n_periods'] == periods_per_year]
+
+    return df \
+        .assign(**{
+            col:df[f'_num_{col}'] / df[w] for col, w in weighted.items()
+        }) \
+        .reset_index(drop=False) \
+        [
+            index_cols + [time_col] \
+            + list(dict.fromkeys(
+                value_cols + [w for w in weighted.values() if w not in helpers]
+            ))
+        ]
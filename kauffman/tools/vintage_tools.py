@@ -0,0 +1,87 @@
+import os
+import json
+import hashlib
+import threading
+import pandas as pd
+from kauffman import constants as c
+
+_manifest_lock = threading.Lock()
+
+
+def _sha256(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def _read_manifest(store_dir):
+    path = os.path.join(store_dir, 'manifest.json')
+    if not os.path.exists(path):
+        return {}
+    with open(path) as f:
+        return json.load(f)
+
+
+def _write_manifest_entry(store_dir, name, entry):
+    # Entries are merged into the manifest on disk under a lock, since
+    # vintages are typically stored from several fetch threads at once
+    with _manifest_lock:
+        manifest = _read_manifest(store_dir)
+        manifest[name] = entry
+        path = os.path.join(store_dir, 'manifest.json')
+        with open(path + '.tmp', 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(path + '.tmp', path)
+
+
+def load_vintage(
+    name, fetch_fn, args=[], store_dir=c.VINTAGE_DIR, version=1
+):
+    """
+    Load a parsed historical vintage from the local vintage store, fetching
+    and storing it first if it isn't there yet. The store's manifest records
+    the parser version and the sha256 of the stored file for each vintage. A
+    stored vintage is only refetched when it was built by a different parser
+    version or its file no longer matches the checksum.
+
+    The checksum covers the stored (parsed) file, not the downloaded source: 
+    it guards the store against corrupted or partially written files. The 
+    source itself is identified by name, which must point to a file that 
+    never changes. fetch_fn should raise on a failed download (ex: with 
+    api_tools._get), so that an error page is never stored.
+
+    Parameters
+    ----------
+    name: str
+        The key of the vintage in the store, identifying its source file. (Ex:
+        'pep/2000_2009_county')
+    fetch_fn: function
+        The function that fetches and parses the vintage into a DataFrame.
+    args: list, default []
+        The arguments to pass to fetch_fn.
+    store_dir: str, default c.VINTAGE_DIR
+        The directory of the store. Defaults to the KAUFFMAN_VINTAGE_DIR 
+        environment variable if set, so that a prebuilt store can be shipped 
+        and shared.
+    version: int, default 1
+        The version of the parser (and schema) that fetch_fn produces. It 
+        should be bumped whenever the parser changes, so that vintages stored
+        by the old parser are rebuilt.
+    """
+    path = os.path.join(store_dir, f'{name}.pkl')
+    entry = _read_manifest(store_dir).get(name)
+    if entry and entry.get('version') == version and os.path.exists(path) \
+        and _sha256(path) == entry['sha256']:
+        return pd.read_pickle(path)
+
+    df = fetch_fn(*args)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_pickle(path + '.tmp')
+    os.replace(path + '.tmp', path)
+    _write_manifest_entry(
+        store_dir, name, 
+        {'file': f'{name}.pkl', 'sha256': _sha256(path), 'version': version}
+    )
+    return df
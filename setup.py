@@ -10,6 +10,7 @@ setup(
         'pandas', 'numpy', 'requests', 'joblib', 'selenium', 'openpyxl',
         'webdriver_manager', 'geonamescache', 'boto3', 'lxml', 'xlrd'
     ],
+    extras_require={'arrow': ['pyarrow']},
     version='2.4.1',
     license='MIT',
     description='Modules that pull and transform commonly used administrative data from online sources.',
@@ -1,5 +1,9 @@
+import tempfile
+import numpy as np
+import pandas as pd
 import kauffman.constants as c
 from kauffman.data import acs, bfs, bds, pep, bed, qwi
+from kauffman.tools import weighted_sum
 from datetime import datetime as dt
 
 
@@ -16,6 +20,12 @@ acs6 = "acs(obs_level='msa', state_lst='all')"
 acs7 = "acs(obs_level='state', state_lst=['CO', 'UT'])"
 acs8 = "acs(obs_level='state', state_lst='all')"
 
+# Compact schema examples
+acs9 = "acs(obs_level='county', state_lst=['CO', 'UT'], compact=True)"
+
+# Variable batching examples
+acs10 = "acs(series_lst=[f'B01001_{i:03}E' for i in range(1, 50)] + list(c.ACS_CODE_TO_VAR), obs_level='county', state_lst=['CO', 'UT'], n_threads=8)"
+
 
 ############### BED tests ###################
 # KESE usage
@@ -34,6 +44,23 @@ bed8 = "bed(series='firm size', table=4)"
 bed9 = "bed(series='establishment age and survival', obs_level='us', table=5, industry='54')"
 bed10 = "bed(series='establishment age and survival', obs_level='state', table=2, industry='81')"
 
+# Compact schema examples
+bed11 = "bed(series='firm size', table=1, compact=True)"
+
+# Annualize examples
+bed12 = "bed(series='firm size', table=2, annualize=True)"
+
+# Threading examples
+bed13 = "bed(series='firm size', table=1, n_threads=9)"
+bed14 = "bed(series='age', obs_level='state', table=1, n_threads=10)"
+
+# Multiple table examples
+bed15 = "bed(series='firm size', table=[1, 2, 3, 4], n_threads=9)[3]"
+bed16 = "bed(series='age', obs_level='state', table=[1, 2, 3, 4], n_threads=10)[4]"
+
+# Age and size examples
+bed17 = "bed(series='age', table='1bf', age='all', size=0)"
+
 
 ############### BDS tests ###################
 # NEB usage
@@ -55,6 +82,12 @@ bds11 = "bds(series_lst='all', obs_level='state', state_list=['PA', 'TN'])"
 bds12 = "bds(series_lst='all', obs_level='county', state_list=['ND'])"
 bds13 = "bds(series_lst=['FIRM'], obs_level='state', state_list=['NJ', 'NY', 'MI'], strata=['EAGE', 'NAICS'])"
 
+# Compact schema examples
+bds14 = "bds(series_lst='all', obs_level='county', state_list=['ND'], strata=['FAGE'], compact=True)"
+
+# Arrow output examples
+bds15 = "bds(series_lst='all', obs_level='state', state_list=['PA', 'TN'], strata=['FAGE'], output='arrow').to_pandas()"
+
 
 ############### BFS tests ###################
 # NEB Usage
@@ -87,6 +120,15 @@ bfs16 = "bfs(['BF_DUR4Q'], obs_level='state', march_shift=False)"
 bfs17 = "bfs('all', obs_level='us', industry='48-49', seasonally_adj=False, annualize=True, march_shift=True)"
 bfs18 = "bfs(['BA_BA'], obs_level='state', annualize=True, march_shift=True)"
 
+# Compact schema examples
+bfs19 = "bfs('all', obs_level='state', industry='all', compact=True)"
+
+# Cache examples
+bfs20 = "bfs(['BA_BA', 'BF_DUR4Q'], obs_level='state', cache=False)"
+
+# DUR only examples
+bfs21 = "bfs(['BF_DUR4Q', 'BF_DUR8Q'], obs_level='us', seasonally_adj=True, cache=False)"
+
 
 ############### PEP tests ###################
 pep1 = "pep(obs_level='us')"
@@ -99,6 +141,15 @@ pep5 = "pep(obs_level='msa', state_list=['CO', 'UT'])"
 pep6 = "pep(obs_level='county', state_list=['GA', 'HI'])"
 pep7 = "pep(obs_level='state', state_list=['IN', 'AL', 'AK', 'TX'])"
 
+# Compact schema examples
+pep8 = "pep(obs_level='county', compact=True)"
+
+# Threading examples
+pep9 = "pep(obs_level='state', n_threads=1)"
+
+# Partitioned dataset examples
+pep10 = "pep(obs_level='county', state_list=['GA', 'HI'], write_to=tempfile.mkdtemp())"
+
 
 ############### QWI tests ###################
 indicators = ['Emp', 'EmpEnd', 'EmpS', 'HirAs', 'Sep', 'EarnBeg', 'FrmJbC']
@@ -160,14 +211,64 @@ qwi33 = "qwi(indicator_list=indicators, obs_level='state', firm_char=['industry'
 qwi34 = "qwi(indicator_list=indicators, obs_level='state', firm_char=['firmsize'], strata_totals=True, n_threads=30)"
 qwi35 = "qwi(indicator_list=indicators, obs_level='state', worker_char=['sex'], strata_totals=True, n_threads=30)"
 
+# Bulk source examples
+qwi36 = "qwi(indicator_list=indicators, obs_level='county', firm_char=['firmage'], source='bulk', n_threads=30)"
+qwi37 = "qwi(indicator_list=indicators, obs_level='msa', state_list=['KS', 'MO'], firm_char=['industry'], worker_char=['sex'], source='bulk', n_threads=30)"
+
+# Partitioned processing examples
+qwi38 = "qwi(indicator_list=indicators, obs_level='county', firm_char=['industry'], worker_char=['sex', 'agegrp'], max_cells=10000000, n_threads=30)"
+qwi39 = "qwi(indicator_list=indicators, obs_level='msa', firm_char=['firmage'], max_cells=1000000, n_threads=30)"
+
+# Compact schema examples
+qwi40 = "qwi(indicator_list=indicators, obs_level='county', firm_char=['industry'], annualize=False, compact=True, n_threads=30)"
+
+# Incremental refresh examples
+qwi41 = "qwi(indicator_list=indicators, obs_level='county', state_list=['DE', 'RI'], annualize=False, prior_df=qwi(indicator_list=indicators, obs_level='county', state_list=['DE', 'RI'], annualize=False).query('time < \"2019-Q1\"'), prior_end_quarter='2018-Q4', n_threads=30)"
+qwi42 = "qwi(indicator_list=indicators, obs_level='county', state_list=['DE', 'RI'], annualize=False, compact=True, prior_df=qwi(indicator_list=indicators, obs_level='county', state_list=['DE', 'RI'], annualize=False, compact=True).query('time < 20191'), prior_end_quarter='2018-Q4', n_threads=30)"
+
+############### Tools tests ###################
+def _weighted_sum_check(strata, weight_var=None, mean=False):
+    """Checks weighted_sum against a groupby on a small offline frame"""
+    df = pd.DataFrame({
+        'fips':['01', '01', '02', '02', '03', '03'],
+        'time':[2019, 2020, 2019, 2019, 2019, 2020],
+        'emp':[1, 2, 3, 4, 5, 6],
+        'estabs':[1.5, np.nan, 2.5, 3.5, 4.5, 5.5],
+        'weight':[1, 2, 0, 0, 3, 1]
+    })
+    var_list = ['emp', 'estabs']
+    w = 1 if weight_var is None else df[weight_var]
+    expected = df[strata] \
+        .assign(**{var:df[var] * w for var in var_list}) \
+        .groupby(strata).sum() \
+        .reset_index()
+    if mean:
+        weights = df[strata] \
+            .assign(**{var:df[var].notna() * w for var in var_list}) \
+            .groupby(strata).sum() \
+            .reset_index()
+        expected[var_list] = (expected[var_list] / weights[var_list]) \
+            .where(weights[var_list] != 0)
+
+    result = weighted_sum(df, strata, var_list, weight_var, mean)
+    pd.testing.assert_frame_equal(result, expected)
+    return result
+
+# Sum, mean, and multiple strata examples
+tools1 = "_weighted_sum_check(['fips'])"
+tools2 = "_weighted_sum_check(['fips'], 'weight', mean=True)"
+tools3 = "_weighted_sum_check(['fips', 'time'], 'weight')"
+
+
 
 module_to_ntests = {
-    'acs': range(1,9),
-    'bed': range(1,11),
-    'bds': range(1,14),
-    'bfs': range(1,19),
-    'pep': range(1,8),
-    'qwi': range(1,36)
+    'acs': range(1,11),
+    'bed': range(1,18),
+    'bds': range(1,16),
+    'bfs': range(1,22),
+    'pep': range(1,11),
+    'qwi': range(1,43),
+    'tools': range(1,4)
 }
 
 